@@ -0,0 +1,58 @@
+"""Общее для бенчмарков: honest-habr.py как модуль и локальный HTTP-сервер.
+
+Скрипты запускаются как `python bench/<имя>.py`, поэтому папка bench уже в sys.path
+и модуль импортируется просто как _common.
+"""
+import http.server
+import importlib.util
+import os
+import tempfile
+import threading
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(ROOT, 'honest-habr.py')
+
+
+def load_app():
+    """Загружает honest-habr.py как модуль honest_habr.
+
+    Без DATA_DIR модуль в Docker смотрит в /app/data, поэтому по умолчанию — временная папка;
+    сценарии, которым нужна своя папка данных, задают DATA_DIR до вызова.
+    """
+    os.environ.setdefault('DATA_DIR', tempfile.gettempdir())
+    spec = importlib.util.spec_from_file_location('honest_habr', SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """Основа обработчиков локального сервера: ответы одной строкой и без логов запросов."""
+
+    def reply(self, body, content_type, headers=None):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # Клиент убит или оборвал запрос — бенчмаркам это не ошибка
+            pass
+
+    def status(self, code):
+        """Ответ без тела: 304, 404 и т. п."""
+        self.send_response(code)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(handler):
+    """Запускает ThreadingHTTPServer с handler (подкласс Handler) в фоне; возвращает базовый URL."""
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}'
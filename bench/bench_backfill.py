@@ -0,0 +1,223 @@
+"""Бэкфилл против локального сервера: прерывание посреди прохода и продолжение с чекпойнта.
+
+Сервер раздаёт постраничную ленту (/rss?page=N, за последней страницей — 404),
+собранную из статей записанной ленты с новыми guid и датами, и OpenAI-совместимый
+/v1/chat/completions с настраиваемой задержкой. Первый запуск
+`honest-habr.py backfill --no-post` убивается через --kill-after секунд, второй
+доходит до конца. Между запусками в начало ленты добавляются --shift новых статей,
+как на живом Хабре: все остальные сдвигаются к следующим страницам. Затем
+проверяется, что в базе ровно статьи из диапазона дат, и считается, сколько страниц
+и запросов к LLM пришлось повторить.
+
+Отдельным запуском проверяется сервер, который не понимает номер страницы
+(/static отдаёт первую страницу на любой ?page=N): бэкфилл должен остановиться
+на первом повторе, а не пройти все --pages одинаковых страниц.
+
+Запуск из корня репозитория:
+
+    python bench/bench_backfill.py [--pages 30] [--per-page 20] [--shift 7] [--kill-after 3] [--llm-latency 100]
+"""
+import argparse
+import copy
+import json
+import os
+import shutil
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from urllib.parse import parse_qs, urlsplit
+
+from lxml import etree
+
+from _common import ROOT, SCRIPT, Handler, serve
+
+# Самая новая статья; дальше — по одной каждые шесть часов в прошлое
+NEWEST = datetime(2026, 1, 1, tzinfo=timezone.utc)
+STEP = timedelta(hours=6)
+
+
+def build_pages(source, pages, per_page, shift=0):
+    """Страницы ленты в байтах и {guid: дата публикации} для всех статей.
+
+    shift — сколько статей новее NEWEST стоит в начале ленты.
+    """
+    with open(source, 'rb') as f:
+        root = etree.fromstring(f.read())
+    channel = root.find('channel')
+    items = channel.findall('item')
+    for item in items:
+        channel.remove(item)
+
+    result, dates = [], {}
+    for page in range(pages):
+        page_root = copy.deepcopy(root)
+        page_channel = page_root.find('channel')
+        for i in range(per_page):
+            number = page * per_page + i - shift
+            item = copy.deepcopy(items[number % len(items)])
+            guid = f'{item.findtext("guid").strip()}?backfill={number}'
+            item.find('guid').text = guid
+            # Уникальный заголовок, иначе повторы отвечались бы из кэша LLM
+            item.find('title').text = f'{item.findtext("title")} #{number}'
+            published = NEWEST - STEP * number
+            item.find('pubDate').text = format_datetime(published, usegmt=True)
+            dates[guid] = published.date()
+            page_channel.append(item)
+        result.append(etree.tostring(page_root, xml_declaration=True, encoding='utf-8'))
+    return result, dates
+
+
+def serve_backfill(pages, llm_latency):
+    hits = Counter()
+    lock = threading.Lock()
+
+    class BackfillHandler(Handler):
+        def do_GET(self):
+            url = urlsplit(self.path)
+            number = int(parse_qs(url.query).get('page', ['1'])[0])
+            with lock:
+                hits['static' if url.path == '/static' else f'page {number}'] += 1
+            if url.path == '/static':
+                number = 1
+            elif url.path != '/rss':
+                number = 0
+            if not 1 <= number <= len(pages):
+                self.status(404)
+                return
+            self.reply(pages[number - 1], 'application/rss+xml; charset=utf-8')
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            with lock:
+                hits['llm'] += 1
+                calls = hits['llm']
+            time.sleep(llm_latency)
+            body = {'choices': [{'message': {'content': f'Заголовок {calls}'}}], 'usage': {'total_tokens': 20}}
+            self.reply(json.dumps(body, ensure_ascii=False).encode('utf-8'), 'application/json')
+
+    return serve(BackfillHandler), hits, lock
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rss', default=os.path.join(ROOT, 'rss.xml'), help='записанная лента')
+    parser.add_argument('--pages', type=int, default=30, help='страниц в ленте')
+    parser.add_argument('--per-page', type=int, default=20, help='статей на странице')
+    parser.add_argument('--since-page', type=int, default=5, help='диапазон дат начинается на этой странице')
+    parser.add_argument('--until-page', type=int, default=20, help='и заканчивается на этой')
+    parser.add_argument('--shift', type=int, default=7, help='статей, добавленных в ленту между запусками')
+    parser.add_argument('--kill-after', type=float, default=3, help='через сколько секунд убить первый запуск')
+    parser.add_argument('--llm-latency', type=float, default=100, help='задержка ответа LLM, мс')
+    parser.add_argument('--concurrency', type=int, default=4, help='BACKFILL_CONCURRENCY')
+    parser.add_argument('--host-rate', type=float, default=5, help='BACKFILL_HOST_RATE, запросов в секунду')
+    args = parser.parse_args()
+
+    pages, dates = build_pages(args.rss, args.pages, args.per_page)
+    # Середина страниц since/until, чтобы диапазон резал их пополам
+    until = (NEWEST - STEP * ((args.until_page - 1) * args.per_page + args.per_page // 2)).date()
+    since = (NEWEST - STEP * ((args.since_page - 1) * args.per_page + args.per_page // 2)).date()
+    since, until = min(since, until), max(since, until)
+    expected = {guid for guid, day in dates.items() if since <= day <= until}
+
+    base, hits, lock = serve_backfill(pages, args.llm_latency / 1000)
+    data_dir = tempfile.mkdtemp(prefix='honest-habr-backfill-')
+    try:
+        shutil.copy(os.path.join(ROOT, 'prompt.txt'), data_dir)
+        env = dict(os.environ)
+        env.pop('FEEDS_FILE', None)
+        env.update({
+            'DATA_DIR': data_dir,
+            'RSS_URL': base + '/rss',
+            'TELEGRAM_BOT_TOKEN': 'bench',
+            'TELEGRAM_CHANNEL_ID': '-100',
+            'LLM_PROVIDERS': 'openai',
+            'OPENAI_BASE_URL': base + '/v1',
+            'OPENAI_CONCURRENCY': '4',
+            'BACKFILL_CONCURRENCY': str(args.concurrency),
+            'BACKFILL_HOST_RATE': str(args.host_rate),
+            # Описания статей повторяются по кругу: перепечатки не должны сокращать число запросов к LLM
+            'DEDUP_MAX_DISTANCE': '-1',
+            'METRICS_PORT': '0',
+        })
+        cmd = [sys.executable, SCRIPT, 'backfill', '--no-post', '--since', since.isoformat(),
+               '--until', until.isoformat(), '--pages', str(args.pages + 5)]
+
+        runs = []
+        for kill_after in (args.kill_after, None):
+            if kill_after is None and args.shift:
+                # Новые статьи сдвигают недокачанные на уже пройденные страницы
+                pages[:] = build_pages(args.rss, args.pages, args.per_page, args.shift)[0]
+            with lock:
+                before = Counter(hits)
+            started = time.perf_counter()
+            proc = subprocess.Popen(cmd, env=env, cwd=data_dir, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+            try:
+                _, stderr = proc.communicate(timeout=kill_after)
+                killed = False
+            except subprocess.TimeoutExpired:
+                proc.send_signal(signal.SIGKILL)
+                _, stderr = proc.communicate()
+                killed = True
+            wall = time.perf_counter() - started
+            if not killed and proc.returncode != 0:
+                sys.exit(f'backfill завершился с кодом {proc.returncode}:\n{stderr[-2000:]}')
+            with lock:
+                delta = Counter(hits)
+                delta.subtract(before)
+            runs.append((wall, killed, delta))
+
+        conn = sqlite3.connect(os.path.join(data_dir, 'articles.db'))
+        stored = {guid for (guid,) in conn.execute('SELECT guid FROM articles')}
+        conn.close()
+
+        # Сервер без постраничности: на каждый ?page=N одна и та же первая страница
+        static_dir = os.path.join(data_dir, 'static')
+        os.mkdir(static_dir)
+        shutil.copy(os.path.join(ROOT, 'prompt.txt'), static_dir)
+        env['DATA_DIR'] = static_dir
+        with lock:
+            before = hits['static']
+        proc = subprocess.run(cmd[:4] + ['--url', base + '/static', '--pages', str(args.pages)],
+                              env=env, cwd=static_dir, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                              text=True, timeout=120)
+        if proc.returncode != 0:
+            sys.exit(f'backfill без постраничности завершился с кодом {proc.returncode}:\n{proc.stderr[-2000:]}')
+        with lock:
+            static_pages = hits['static'] - before
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    print(f'лента: {args.pages} стр. по {args.per_page}, сдвиг между запусками {args.shift}, '
+          f'диапазон {since} — {until}, статей в диапазоне: {len(expected)}')
+    for number, (wall, killed, delta) in enumerate(runs, 1):
+        fetched = sum(count for key, count in delta.items() if key.startswith('page'))
+        status = 'убит' if killed else 'завершён'
+        print(f'== запуск {number} ({status}): {wall:7.2f} с, страниц загружено {fetched}, запросов к LLM {delta["llm"]}')
+
+    total_llm = sum(delta['llm'] for _, _, delta in runs)
+    repeated_pages = sum(
+        1 for key in hits if key.startswith('page') and all(delta[key] for _, _, delta in runs)
+    )
+    print(f'повторно загружено страниц: {repeated_pages}, лишних запросов к LLM: {total_llm - len(expected)}')
+    if not runs[0][1]:
+        print('Внимание: первый запуск успел закончиться, увеличьте --pages или уменьшите --kill-after', file=sys.stderr)
+    print(f'== сервер без постраничности: загружено страниц {static_pages} из {args.pages}')
+    # Повтор замечается, как только загружены две соседние страницы; лишними могут
+    # оказаться только уже начатые воркерами загрузки
+    if static_pages > 2 * args.concurrency + 1:
+        sys.exit('Бэкфилл не остановился на повторяющихся страницах')
+    if stored != expected:
+        sys.exit(f'В базе {len(stored)} статей, ожидалось {len(expected)}: '
+                 f'лишних {len(stored - expected)}, не хватает {len(expected - stored)}')
+    print('В базе ровно статьи из диапазона.')
+
+
+if __name__ == '__main__':
+    main()
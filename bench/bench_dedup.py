@@ -0,0 +1,100 @@
+"""Поиск перепечаток: скорость simhash + SimilarityIndex.find и качество на правках статей.
+
+Индекс заполняется статьями записанной ленты и --filler случайными отпечатками
+(столько статей хранится в базе за пару месяцев). Затем ищутся:
+
+    копии      — описание без изменений;
+    правки     — заменено --edit процентов слов;
+    обрезки    — отброшен хвост в --cut процентов;
+    вступления — добавлен абзац от перепечатавшего блога;
+    чужие      — описания других статей ленты (должны не находиться).
+
+Запуск из корня репозитория:
+
+    python bench/bench_dedup.py [путь к rss.xml] [--filler 10000] [--edit 5] [--cut 10] [--repeat 5]
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import time
+
+from lxml import etree
+
+from _common import ROOT, load_app
+
+INTRO = ('Это перевод статьи, опубликованной в блоге компании. '
+         'Подписывайтесь на наш канал, чтобы не пропустить новые материалы.')
+
+
+def variants(text, rnd, edit, cut):
+    words = text.split()
+    edited = list(words)
+    for i in rnd.sample(range(len(words)), len(words) * edit // 100):
+        edited[i] = f'правка{rnd.randrange(10 ** 6)}'
+    return {
+        'копии': text,
+        'правки': ' '.join(edited),
+        'обрезки': ' '.join(words[:len(words) - len(words) * cut // 100]),
+        'вступления': f'{INTRO} {text}',
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('rss', nargs='?', default=os.path.join(ROOT, 'rss.xml'))
+    parser.add_argument('--filler', type=int, default=10000, help='случайных отпечатков в индексе')
+    parser.add_argument('--edit', type=int, default=5, help='процент заменённых слов')
+    parser.add_argument('--cut', type=int, default=10, help='процент отброшенного хвоста')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    app = load_app()
+    with open(args.rss, 'rb') as f:
+        items = etree.fromstring(f.read()).find('channel').findall('item')
+    descriptions = [app.preprocess_entry(item.findtext('title') or '', item.findtext('description') or '').description
+                    for item in items]
+    descriptions = [d for d in descriptions if app.simhash(d) is not None]
+    if len(descriptions) < 2:
+        sys.exit(f'В {args.rss} меньше двух статей длиннее DEDUP_MIN_WORDS слов')
+
+    rnd = random.Random(1)
+    conn = sqlite3.connect(':memory:')
+    conn.execute('CREATE TABLE articles (guid TEXT PRIMARY KEY, new_title TEXT)')
+    index = app.SimilarityIndex(conn, app.DEDUP_MAX_DISTANCE)
+    stored = descriptions[::2]
+    for number, text in enumerate(stored):
+        conn.execute('INSERT INTO articles VALUES (?, ?)', (f'rss{number}', ''))
+        index.add(f'rss{number}', app.simhash(text))
+    for number in range(args.filler):
+        conn.execute('INSERT INTO articles VALUES (?, ?)', (f'filler{number}', ''))
+        index.add(f'filler{number}', rnd.getrandbits(64))
+    conn.commit()
+
+    cases = {}
+    for number, text in enumerate(stored):
+        for name, variant in variants(text, rnd, args.edit, args.cut).items():
+            cases.setdefault(name, []).append((variant, f'rss{number}'))
+    cases['чужие'] = [(text, None) for text in descriptions[1::2]]
+
+    print(f'DEDUP_MAX_DISTANCE={index.max_distance}, полос: {len(index.bands)}, '
+          f'в индексе: {len(stored) + args.filler}, повторов: {args.repeat} (лучшее время)')
+    failed = False
+    for name, pairs in cases.items():
+        best = float('inf')
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            found = [index.find(app.simhash(text)) for text, _ in pairs]
+            best = min(best, time.perf_counter() - started)
+        hits = sum(1 for (_, expected), match in zip(pairs, found) if match and match[0] == expected)
+        wrong = sum(1 for (_, expected), match in zip(pairs, found) if match and match[0] != expected)
+        print(f'{name:<11} {len(pairs):4} шт.  найдено верно {hits:4}, ошибочно {wrong:4}  '
+              f'{best / len(pairs) * 1e6:7.1f} мкс/статья')
+        failed = failed or wrong > 0
+    if failed:
+        sys.exit('Есть ложные совпадения')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+"""Проверка доставки в Telegram на фейковом Bot: один канал не должен задерживать другой.
+
+Сценарии:
+
+    flood    — посты вперемешку a1, b1, a2, b2, a3; первая отправка в канал A получает
+               RetryAfter(--retry-after). Канал B не ждёт паузы, канал A получает
+               посты по порядку (a1, a2, a3), a1 — после паузы;
+    backlog  — в очереди --backlog постов канала A, затем один пост канала B, лимит
+               канала — 1 пост в секунду. Пост канала B уходит сразу, а не после
+               того, как очередь A станет короче выборки outbox_due.
+
+Если что-то не так, завершается с ошибкой.
+
+Запуск из корня репозитория:
+
+    python bench/bench_delivery.py [--retry-after 3] [--backlog 60] [--latency 20]
+"""
+import argparse
+import asyncio
+import logging
+import shutil
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+from telegram.error import RetryAfter
+
+from _common import load_app
+
+CHAT_A, CHAT_B = '-1001', '-1002'
+QUEUE = [('a1', CHAT_A), ('b1', CHAT_B), ('a2', CHAT_A), ('b2', CHAT_B), ('a3', CHAT_A)]
+
+
+class FloodBot:
+    """Первая отправка в flood_chat получает RetryAfter, остальное записывается с временем."""
+
+    def __init__(self, latency, flood_chat=None, retry_after=0):
+        self.latency = latency
+        self.flood_chat = flood_chat
+        self.retry_after = retry_after
+        self.flooded = False
+        self.sent = []
+        self.started = time.monotonic()
+
+    async def send_message(self, chat_id, text, parse_mode, **kwargs):
+        await asyncio.sleep(self.latency)
+        if chat_id == self.flood_chat and not self.flooded:
+            self.flooded = True
+            raise RetryAfter(self.retry_after)
+        self.sent.append((chat_id, text, time.monotonic() - self.started))
+        return SimpleNamespace(photo=None)
+
+    async def send_photo(self, chat_id, photo, caption, parse_mode, **kwargs):
+        return await self.send_message(chat_id, caption, parse_mode)
+
+    async def shutdown(self):
+        pass
+
+
+async def deliver(app, data_dir, bot, queue, per_chat_rate, until=None, timeout=None):
+    """Ставит queue [(guid, chat_id)] в outbox и отправляет через TelegramDelivery.
+
+    until — условие по bot.sent, после которого доставка прерывается, не дожидаясь
+    конца очереди; timeout — предел ожидания, с.
+    """
+    store = app.open_article_store(data_dir)
+    try:
+        for guid, chat_id in queue:
+            store.add(guid, guid, guid, posts=[(chat_id, {'text': guid})])
+        limiter = app.TelegramRateLimiter(1000, per_chat_rate * 60)
+        delivery = app.TelegramDelivery(lambda: bot, store, limiter)
+        if until is None:
+            # close() до старта: доставка дошлёт очередь и завершится
+            delivery.close()
+            await asyncio.wait_for(delivery.run(), timeout)
+            return
+        task = asyncio.create_task(delivery.run())
+        started = time.monotonic()
+        while not until(bot.sent) and time.monotonic() - started < timeout:
+            await asyncio.sleep(0.05)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    finally:
+        store.close()
+
+
+def run_scenario(app, bot, queue, per_chat_rate, until=None, timeout=60):
+    data_dir = tempfile.mkdtemp(prefix='honest-habr-delivery-')
+    try:
+        asyncio.run(deliver(app, data_dir, bot, queue, per_chat_rate, until, timeout))
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def check_flood(app, args):
+    bot = FloodBot(args.latency / 1000, CHAT_A, args.retry_after)
+    run_scenario(app, bot, QUEUE, 1000)
+    print('== flood')
+    for chat_id, text, at in bot.sent:
+        print(f'{at:6.2f} с  {chat_id}  {text}')
+
+    errors = []
+    order_a = [text for chat_id, text, _ in bot.sent if chat_id == CHAT_A]
+    if order_a != ['a1', 'a2', 'a3']:
+        errors.append(f'канал A получил посты не по порядку: {order_a}')
+    late_b = [(text, at) for chat_id, text, at in bot.sent if chat_id == CHAT_B and at >= args.retry_after]
+    if late_b:
+        errors.append(f'канал B ждал паузы канала A: {late_b}')
+    first_a = next((at for chat_id, _, at in bot.sent if chat_id == CHAT_A), None)
+    if first_a is None or first_a < args.retry_after:
+        errors.append('канал A не выдержал паузу RetryAfter')
+    return errors
+
+
+def check_backlog(app, args):
+    bot = FloodBot(args.latency / 1000)
+    queue = [(f'a{i}', CHAT_A) for i in range(1, args.backlog + 1)] + [('b1', CHAT_B)]
+
+    def b_sent(sent):
+        return any(chat_id == CHAT_B for chat_id, _, _ in sent)
+
+    run_scenario(app, bot, queue, 1, until=b_sent, timeout=15)
+    sent_b = next((at for chat_id, _, at in bot.sent if chat_id == CHAT_B), None)
+    sent_a = sum(1 for chat_id, _, _ in bot.sent if chat_id == CHAT_A)
+    print('== backlog')
+    print(f'в очереди A: {args.backlog}, до поста B ушло из A: {sent_a}, '
+          f'B отправлен через {"—" if sent_b is None else f"{sent_b:.2f} с"}')
+    # Лимит чата — 1 в секунду с запасом в 3 поста: B не должен ждать очереди A
+    if sent_b is None or sent_b > 1:
+        return ['канал B ждал, пока разойдётся очередь канала A']
+    return []
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--retry-after', type=int, default=3, help='пауза RetryAfter для канала A, с')
+    parser.add_argument('--backlog', type=int, default=60, help='постов канала A в сценарии backlog')
+    parser.add_argument('--latency', type=float, default=20, help='задержка ответа фейкового Bot, мс')
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    app = load_app()
+    errors = check_flood(app, args) + check_backlog(app, args)
+    if errors:
+        sys.exit('\n'.join(errors))
+    print('Порядок в канале A сохранён, канал B не ждёт канал A.')
+
+
+if __name__ == '__main__':
+    main()
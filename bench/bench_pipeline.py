@@ -0,0 +1,316 @@
+"""Офлайн-бенчмарк всего прохода main_async: записанная лента, фейковый LLM и фейковый Telegram.
+
+Habr, LLM и Telegram не нужны: лента и картинки статей раздаются локальным
+HTTP-сервером, провайдер LLM и Bot подменяются заглушками с настраиваемой задержкой. Каждый сценарий
+запускается в отдельном процессе, чтобы пиковая память не накапливалась.
+
+Сценарий malformed — записанная лента с неэкранированным & в заголовке: lxml её
+не разбирает, и она идёт через feedparser. Проверяется, что выходная лента всё равно
+записана со всеми статьями и валидаторы ленты сохранены, то есть следующий опрос
+не будет заново скачивать и разбирать её.
+
+Запуск из корня репозитория:
+
+    python bench/bench_pipeline.py [--sizes rss,malformed,1000,10000] [--llm-latency 200] [--bot-latency 50]
+    python bench/bench_pipeline.py --compare bench/results/<старый коммит>.json
+
+Результаты пишутся в bench/results/<коммит>.json (или в --output).
+"""
+import argparse
+import asyncio
+import copy
+import io
+import json
+import logging
+import os
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+from lxml import etree
+
+from _common import ROOT, Handler, load_app, serve
+
+RESULTS_DIR = os.path.join(ROOT, 'bench', 'results')
+
+
+# PNG 1x1 на случай, если Pillow не установлен
+TINY_PNG = bytes.fromhex(
+    '89504e470d0a1a0a0000000d4948445200000001000000010806000000'
+    '1f15c4890000000d49444154789c6360000002000001e221bc330000000049454e44ae426082'
+)
+
+
+def sample_image(side):
+    try:
+        from PIL import Image
+    except ImportError:
+        return TINY_PNG, 'image/png'
+    out = io.BytesIO()
+    Image.new('RGB', (side, side * 2 // 3), (40, 120, 200)).save(out, format='JPEG', quality=90)
+    return out.getvalue(), 'image/jpeg'
+
+
+def build_feed(source, size, image_base):
+    """size='rss' — записанная лента как есть, 'malformed' — она же с ошибкой XML,
+    иначе её статьи размножаются до size штук с новыми guid.
+
+    Картинки с habrastorage.org переадресуются на image_base.
+    """
+    with open(source, 'rb') as f:
+        data = f.read().replace(b'https://habrastorage.org/', image_base.encode())
+    if size == 'rss':
+        return data
+    if size == 'malformed':
+        # Голый & — фатальная ошибка для lxml, feedparser читает такую ленту в нестрогом режиме
+        return re.sub(rb'(<item>\s*<title>)', rb'\1Q&A: ', data, count=1)
+
+    root = etree.fromstring(data)
+    channel = root.find('channel')
+    items = channel.findall('item')
+    for item in items:
+        channel.remove(item)
+    for i in range(int(size)):
+        item = copy.deepcopy(items[i % len(items)])
+        for tag in ('guid', 'link'):
+            elem = item.find(tag)
+            if elem is not None and elem.text:
+                elem.text = f'{elem.text.strip()}?bench={i}'
+        channel.append(item)
+    return etree.tostring(root, xml_declaration=True, encoding='utf-8')
+
+
+def serve_routes(routes):
+    """Локальный сервер: routes — {префикс пути: (байты, Content-Type)}, можно дополнять после запуска."""
+    class RoutesHandler(Handler):
+        def do_GET(self):
+            for prefix, (body, content_type) in routes.items():
+                if self.path.startswith(prefix):
+                    self.reply(body, content_type)
+                    return
+            self.status(404)
+
+    return serve(RoutesHandler)
+
+
+class FakeBot:
+    def __init__(self, latency):
+        self.latency = latency
+        self.sent = 0
+        self.uploads = 0
+
+    async def send_photo(self, chat_id, photo, caption, parse_mode, **kwargs):
+        await asyncio.sleep(self.latency)
+        self.sent += 1
+        if isinstance(photo, bytes):
+            self.uploads += 1
+        return SimpleNamespace(photo=[SimpleNamespace(file_id=f'fake-{self.sent}')])
+
+    async def send_message(self, chat_id, text, parse_mode, **kwargs):
+        await asyncio.sleep(self.latency)
+        self.sent += 1
+
+    async def shutdown(self):
+        pass
+
+
+def fake_provider_class(app):
+    class FakeProvider(app.LLMProvider):
+        kind = 'fake'
+
+        def __init__(self, latency, concurrency):
+            super().__init__('fake', 'fake', concurrency)
+            self.latency = latency
+            self.calls = 0
+
+        async def complete(self, messages, max_tokens, temperature, json_mode=False):
+            await asyncio.sleep(self.latency)
+            self.calls += 1
+            if json_mode:
+                ids = re.findall(r'"id": "(\d+)"', messages[-1]['content'])
+                titles = {item_id: f'Заголовок {self.calls}.{item_id}' for item_id in ids}
+                return json.dumps({'titles': titles}, ensure_ascii=False), 20 * len(ids)
+            return f'Заголовок {self.calls}', 20
+
+    return FakeProvider
+
+
+def run_worker(args):
+    """Один сценарий в текущем процессе; результат — JSON в stdout."""
+    data_dir = tempfile.mkdtemp(prefix='honest-habr-bench-')
+    try:
+        for name in ('prompt.txt', 'prompt_batch.txt'):
+            shutil.copy(os.path.join(ROOT, name), data_dir)
+        routes = {'/img/': sample_image(args.image_side)}
+        base = serve_routes(routes)
+        feed = build_feed(args.rss, args.worker, base + '/img/')
+        routes['/rss'] = (feed, 'application/rss+xml; charset=utf-8')
+        os.environ.update({
+            'DATA_DIR': data_dir,
+            'RSS_URL': base + '/rss',
+            'TELEGRAM_BOT_TOKEN': 'bench',
+            'TELEGRAM_CHANNEL_ID': '-100',
+            'TELEGRAM_RATE_GLOBAL': '1000000',
+            'TELEGRAM_RATE_PER_CHAT': '1000000',
+            'LLM_BATCH_SIZE': str(args.batch_size),
+            # Размноженные статьи — копии друг друга: с поиском перепечаток LLM почти не вызывался бы
+            'DEDUP_MAX_DISTANCE': '-1',
+            'METRICS_PORT': '0',
+        })
+        os.environ.pop('FEEDS_FILE', None)
+        logging.disable(logging.WARNING)
+
+        app = load_app()
+        bot = FakeBot(args.bot_latency / 1000)
+        provider = fake_provider_class(app)(args.llm_latency / 1000, args.llm_concurrency)
+        app.build_bot = lambda http: bot
+        app.build_llm_router = lambda http: app.LLMRouter([provider], app.LLM_FAILURE_THRESHOLD, app.LLM_COOLDOWN)
+
+        started = time.perf_counter()
+        asyncio.run(app.main_async())
+        wall = time.perf_counter() - started
+
+        try:
+            with open(os.path.join(data_dir, 'rss.xml'), 'rb') as f:
+                output_items = len(etree.fromstring(f.read()).find('channel').findall('item'))
+        except (OSError, etree.XMLSyntaxError):
+            output_items = 0
+        try:
+            with open(os.path.join(data_dir, app.FEED_CACHE_FILE), 'r', encoding='utf-8') as f:
+                validators_saved = os.environ['RSS_URL'] in json.load(f)
+        except (OSError, ValueError):
+            validators_saved = False
+
+        summary = app.metrics.summary()
+        items = summary['counters'].get('articles_seen', 0)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # На Linux ru_maxrss в килобайтах, на macOS в байтах
+        peak_mb = peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+        result = {
+            'items': items,
+            'feed_bytes': len(feed),
+            'wall': wall,
+            'throughput': items / wall if wall else 0.0,
+            'peak_rss_mb': peak_mb,
+            'llm_calls': provider.calls,
+            'telegram_sent': bot.sent,
+            'photo_uploads': bot.uploads,
+            'output_items': output_items,
+            'validators_saved': validators_saved,
+            'counters': summary['counters'],
+            'stages': summary['stages'],
+        }
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+    json.dump(result, sys.stdout)
+
+
+def git_commit():
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True)
+        commit = out.stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--', 'honest-habr.py'], cwd=ROOT, capture_output=True, text=True)
+        return commit + ('-dirty' if dirty.stdout.strip() else '')
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def print_scenario(name, result, baseline=None):
+    def delta(new, old, lower_is_better=True):
+        if not old:
+            return ''
+        change = (new - old) / old * 100
+        better = change < 0 if lower_is_better else change > 0
+        return f'  ({change:+.1f}%{"" if abs(change) < 5 else (" лучше" if better else " хуже")})'
+
+    old = baseline or {}
+    print(f'== {name}: статей {result["items"]}, лента {result["feed_bytes"] / 1024:.0f} КБ')
+    print(f'   время прохода   {result["wall"]:9.3f} с{delta(result["wall"], old.get("wall"))}')
+    print(f'   пропускная      {result["throughput"]:9.1f} статей/с'
+          f'{delta(result["throughput"], old.get("throughput"), lower_is_better=False)}')
+    print(f'   пиковая память  {result["peak_rss_mb"]:9.1f} МБ{delta(result["peak_rss_mb"], old.get("peak_rss_mb"))}')
+    print(f'   запросов к LLM  {result["llm_calls"]:9d}, постов в Telegram {result["telegram_sent"]}'
+          f', загрузок картинок {result.get("photo_uploads", 0)}')
+    if 'output_items' in result:
+        print(f'   в выходной ленте {result["output_items"]} статей, '
+              f'валидаторы {"сохранены" if result["validators_saved"] else "НЕ сохранены"}')
+    print(f'   {"этап":<28}{"n":>7}{"p50, мс":>11}{"p90, мс":>11}{"p99, мс":>11}{"всего, с":>11}')
+    old_stages = old.get('stages', {})
+    for stage, timing in result['stages'].items():
+        line = (f'   {stage:<28}{timing["count"]:>7}{timing["p50"] * 1000:>11.2f}{timing["p90"] * 1000:>11.2f}'
+                f'{timing["p99"] * 1000:>11.2f}{timing["sum"]:>11.3f}')
+        if stage in old_stages:
+            line += delta(timing['sum'], old_stages[stage]['sum'])
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rss', default=os.path.join(ROOT, 'rss.xml'), help='записанная лента')
+    parser.add_argument('--sizes', default='rss,malformed,1000,10000',
+                        help='сценарии: rss, malformed и/или число статей')
+    parser.add_argument('--llm-latency', type=float, default=200, help='задержка ответа LLM, мс')
+    parser.add_argument('--llm-concurrency', type=int, default=4, help='параллельных запросов к LLM')
+    parser.add_argument('--bot-latency', type=float, default=50, help='задержка отправки в Telegram, мс')
+    parser.add_argument('--batch-size', type=int, default=1, help='LLM_BATCH_SIZE')
+    parser.add_argument('--image-side', type=int, default=1600, help='длинная сторона картинок статей, px')
+    parser.add_argument('--output', help='куда сохранить результаты (по умолчанию bench/results/<коммит>.json)')
+    parser.add_argument('--compare', help='результаты прошлого запуска для сравнения')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args)
+        return
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    params = {
+        'llm_latency_ms': args.llm_latency,
+        'llm_concurrency': args.llm_concurrency,
+        'bot_latency_ms': args.bot_latency,
+        'batch_size': args.batch_size,
+        'image_side': args.image_side,
+    }
+    if baseline and baseline.get('params') != params:
+        print(f'Внимание: параметры отличаются от {args.compare}: {baseline.get("params")}', file=sys.stderr)
+
+    commit = git_commit()
+    results = {'commit': commit, 'created_at': time.time(), 'params': params, 'scenarios': {}}
+    failed = []
+    for size in [s.strip() for s in args.sizes.split(',') if s.strip()]:
+        cmd = [
+            sys.executable, os.path.abspath(__file__), '--worker', size, '--rss', args.rss,
+            '--llm-latency', str(args.llm_latency), '--llm-concurrency', str(args.llm_concurrency),
+            '--bot-latency', str(args.bot_latency), '--batch-size', str(args.batch_size),
+            '--image-side', str(args.image_side),
+        ]
+        proc = subprocess.run(cmd, capture_output=True, text=True)
+        if proc.returncode != 0:
+            sys.exit(f'Сценарий {size} упал:\n{proc.stderr}')
+        result = json.loads(proc.stdout)
+        results['scenarios'][size] = result
+        old = baseline['scenarios'].get(size) if baseline else None
+        print_scenario(size, result, old)
+        if size == 'malformed' and not (result['output_items'] and result['validators_saved']):
+            failed.append(size)
+
+    output = args.output or os.path.join(RESULTS_DIR, f'{commit}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=4)
+    print(f'Результаты сохранены в {output}')
+    if failed:
+        sys.exit(f'Лента, прочитанная feedparser, не записана или её валидаторы не сохранены: {", ".join(failed)}')
+
+
+if __name__ == '__main__':
+    main()
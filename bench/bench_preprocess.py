@@ -0,0 +1,107 @@
+"""Микро-бенчмарк предобработки статей: старые функции на BeautifulSoup против preprocess_entry.
+
+Старая реализация нужна только здесь, поэтому beautifulsoup4 не входит в requirements.txt,
+а перечислен в зависимостях бенчмарков:
+
+    pip install -r bench/requirements.txt
+
+Запуск из корня репозитория:
+
+    python bench/bench_preprocess.py [путь к rss.xml] [--repeat N]
+"""
+import argparse
+import os
+import sys
+import time
+
+import feedparser
+from bs4 import BeautifulSoup
+
+from _common import ROOT, load_app
+
+
+# Старая реализация — три-четыре разбора html.parser на статью
+def legacy_clean_text(html_content):
+    soup = BeautifulSoup(html_content, 'html.parser')
+    for img in soup.find_all('img'):
+        img.decompose()
+    return soup.get_text(separator=' ', strip=True)
+
+
+def legacy_clean_description_for_telegram(html_content):
+    soup = BeautifulSoup(html_content, 'html.parser')
+    for img in soup.find_all('img'):
+        img.decompose()
+    for tag in soup.find_all(['div', 'span']):
+        tag.unwrap()
+    for p in soup.find_all('p'):
+        p.replace_with('\n\n' + p.get_text(strip=True))
+    for br in soup.find_all('br'):
+        br.replace_with('\n')
+    for strong in soup.find_all('strong'):
+        strong.name = 'b'
+    for em in soup.find_all('em'):
+        em.name = 'i'
+    return str(soup)
+
+
+def legacy_get_first_image_url(html_content):
+    soup = BeautifulSoup(html_content, 'html.parser')
+    img = soup.find('img')
+    if img and 'src' in img.attrs:
+        return img['src']
+    return None
+
+
+def legacy_preprocess(old_title, description):
+    clean_desc = legacy_clean_description_for_telegram(description)
+    return (
+        legacy_clean_text(old_title),
+        legacy_clean_text(description),
+        legacy_get_first_image_url(description),
+        [p.strip() for p in clean_desc.split('\n\n') if p.strip()],
+    )
+
+
+def bench(func, pairs, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for title, description in pairs:
+            func(title, description)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('rss', nargs='?', default=os.path.join(ROOT, 'rss.xml'))
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    app = load_app()
+    with open(args.rss, 'r', encoding='utf-8') as f:
+        feed = feedparser.parse(f.read())
+    pairs = [(e.get('title', ''), e.get('description', '')) for e in feed.entries]
+    if not pairs:
+        sys.exit(f'В {args.rss} нет статей')
+
+    # Сначала убеждаемся, что результат не изменился
+    mismatches = 0
+    for title, description in pairs:
+        if tuple(app.preprocess_entry(title, description)) != legacy_preprocess(title, description):
+            mismatches += 1
+    if mismatches:
+        sys.exit(f'Результаты расходятся на {mismatches} из {len(pairs)} статей')
+
+    legacy = bench(legacy_preprocess, pairs, args.repeat)
+    current = bench(app.preprocess_entry, pairs, args.repeat)
+
+    print(f'статей: {len(pairs)}, повторов: {args.repeat} (лучшее время)')
+    print(f'BeautifulSoup x4:   {legacy * 1000:8.2f} мс  ({legacy / len(pairs) * 1e6:8.1f} мкс/статья)')
+    print(f'preprocess_entry:   {current * 1000:8.2f} мс  ({current / len(pairs) * 1e6:8.1f} мкс/статья)')
+    print(f'ускорение:          {legacy / current:8.1f}x')
+
+
+if __name__ == '__main__':
+    main()
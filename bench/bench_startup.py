@@ -0,0 +1,148 @@
+"""Бенчмарк запуска --once, когда работы нет: время прохода и импорты по -X importtime.
+
+Сценарии (каждый — отдельный процесс python -X importtime honest-habr.py --once):
+
+    import     — только загрузка модуля;
+    known      — лента изменилась, но все статьи уже обработаны и разосланы;
+    unchanged  — сервер ответил 304 Not Modified.
+
+Лента раздаётся локальным HTTP-сервером с ETag, база заполняется через articles.json.
+Если в сценарии без работы импортировался groq, telegram, feedparser или PIL,
+бенчмарк завершается с ошибкой.
+
+Запуск из корня репозитория:
+
+    python bench/bench_startup.py [путь к rss.xml] [--repeat N] [--top N]
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from _common import ROOT, SCRIPT, Handler, serve
+
+# Модули, которые не должны грузиться, пока нет новых статей
+HEAVY = ('groq', 'telegram', 'feedparser', 'PIL')
+
+LOAD_MODULE = (
+    "import importlib.util, sys;"
+    "spec = importlib.util.spec_from_file_location('honest_habr', sys.argv[1]);"
+    "spec.loader.exec_module(importlib.util.module_from_spec(spec))"
+)
+
+
+def serve_feed(feed):
+    etag = '"%s"' % hashlib.sha256(feed).hexdigest()[:16]
+
+    class FeedHandler(Handler):
+        def do_GET(self):
+            if self.headers.get('If-None-Match') == etag:
+                self.status(304)
+                return
+            self.reply(feed, 'application/rss+xml; charset=utf-8', {'ETag': etag})
+
+    return serve(FeedHandler) + '/rss'
+
+
+def parse_importtime(stderr):
+    """{модуль: накопленное время, мкс} для импортов верхнего уровня и множество всех модулей."""
+    top = {}
+    seen = set()
+    for line in stderr.splitlines():
+        match = re.match(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)', line)
+        if not match:
+            continue
+        seen.add(match.group(4))
+        if len(match.group(3)) == 1:
+            top[match.group(4)] = top.get(match.group(4), 0) + int(match.group(2))
+    return top, seen
+
+
+def run(args, env, cwd):
+    started = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime'] + args, env=env, cwd=cwd,
+        capture_output=True, text=True, timeout=120,
+    )
+    wall = time.perf_counter() - started
+    if proc.returncode != 0:
+        sys.exit(f'{" ".join(args)} завершился с кодом {proc.returncode}:\n{proc.stderr[-2000:]}')
+    top, seen = parse_importtime(proc.stderr)
+    return wall, top, seen, proc.stderr
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('rss', nargs='?', default=os.path.join(ROOT, 'rss.xml'))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=8, help="сколько самых долгих импортов показать")
+    args = parser.parse_args()
+
+    with open(args.rss, 'rb') as f:
+        feed = f.read()
+    guids = [g.strip() for g in re.findall(rb'<guid[^>]*>([^<]+)</guid>', feed)]
+    if not guids:
+        sys.exit(f'В {args.rss} нет статей с guid')
+
+    data_dir = tempfile.mkdtemp(prefix='honest-habr-startup-')
+    try:
+        shutil.copy(os.path.join(ROOT, 'prompt.txt'), data_dir)
+        env = dict(os.environ)
+        env.pop('FEEDS_FILE', None)
+        env.update({
+            'DATA_DIR': data_dir,
+            'RSS_URL': serve_feed(feed),
+            'TELEGRAM_BOT_TOKEN': 'bench',
+            'TELEGRAM_CHANNEL_ID': '-100',
+            'LLM_PROVIDERS': 'groq',
+            'GROQ_API_KEY': 'bench',
+            'METRICS_PORT': '0',
+        })
+
+        results = []
+        for name in ('import', 'known', 'unchanged'):
+            best = None
+            for _ in range(args.repeat):
+                # Перед каждым повтором «known» база снова содержит все статьи, а кэша ленты нет
+                if name == 'known':
+                    for file in os.listdir(data_dir):
+                        if file != 'prompt.txt':
+                            os.remove(os.path.join(data_dir, file))
+                    articles = {g.decode(): {'old_title': 'old', 'new_title': 'new'} for g in guids}
+                    with open(os.path.join(data_dir, 'articles.json'), 'w', encoding='utf-8') as f:
+                        json.dump(articles, f)
+                argv = ['-c', LOAD_MODULE, SCRIPT] if name == 'import' else [SCRIPT, '--once']
+                result = run(argv, env, data_dir)
+                if best is None or result[0] < best[0]:
+                    best = result
+            wall, top, seen, stderr = best
+            if name == 'unchanged' and 'не изменилась' not in stderr:
+                sys.exit('Сценарий unchanged не получил 304 от сервера')
+            if name == 'known' and 'Новых статей нет' not in stderr:
+                sys.exit('Сценарий known не пошёл по быстрому пути')
+            results.append((name, wall, top, seen))
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    failed = False
+    print(f'статей в ленте: {len(guids)}, повторов: {args.repeat} (лучшее время)')
+    for name, wall, top, seen in results:
+        heavy = sorted(m for m in seen if m.split('.')[0] in HEAVY and '.' not in m)
+        print(f'== {name}: {wall * 1000:8.1f} мс на процесс, импорты {sum(top.values()) / 1000:8.1f} мс')
+        for module, cumulative in sorted(top.items(), key=lambda item: -item[1])[:args.top]:
+            print(f'   {module:<30} {cumulative / 1000:8.1f} мс')
+        if heavy:
+            failed = True
+            print(f'   лишние импорты: {", ".join(heavy)}')
+    if failed:
+        sys.exit('Запуск без работы импортирует тяжёлые модули')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,36 @@
 import logging
+import argparse
+import calendar
+import cProfile
+import fcntl
+import hashlib
 import json
 import os
+import random
+import re
+import signal
+import sqlite3
+import statistics
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import date, timedelta, timezone
+from email.utils import formatdate, parsedate_to_datetime
 from dotenv import load_dotenv
-import feedparser
-import requests
-from groq import Groq
-from telegram import Bot
-from telegram.constants import ParseMode  # <-- Вот правильный импорт
+import httpx
 import asyncio
-from bs4 import BeautifulSoup
-import xml.etree.ElementTree as ET
+import html
+import importlib.util
+import io
+from urllib.parse import urlsplit
+from typing import TYPE_CHECKING, List, NamedTuple, Optional
+import lxml.html
+from lxml import etree
+
+# groq, python-telegram-bot, feedparser и Pillow вместе грузятся дольше секунды,
+# а большинство запусков не находит новых статей. Они импортируются там, где нужны
+if TYPE_CHECKING:
+    from telegram import Bot
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -23,127 +44,2268 @@ TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 TELEGRAM_CHANNEL_ID = os.getenv('TELEGRAM_CHANNEL_ID')
 RSS_OUTPUT_FILE = os.getenv('RSS_OUTPUT_FILE', 'rss.xml')
 
-ARTICLES_FILE = 'articles.json'
+# LLM-провайдеры в порядке предпочтения: groq, openai (любой OpenAI-совместимый сервер), amvera
+LLM_PROVIDERS = os.getenv('LLM_PROVIDERS', 'groq')
+# Сколько ошибок подряд выключают провайдера и на сколько секунд
+LLM_FAILURE_THRESHOLD = max(1, int(os.getenv('LLM_FAILURE_THRESHOLD', '3')))
+LLM_COOLDOWN = float(os.getenv('LLM_COOLDOWN', '120'))
 
-def clean_text(html_content):
-    soup = BeautifulSoup(html_content, 'html.parser')
-    for img in soup.find_all('img'):
-        img.decompose()
-    return soup.get_text(separator=' ', strip=True)
-
-def clean_description_for_telegram(html_content):
-    soup = BeautifulSoup(html_content, 'html.parser')
-    for img in soup.find_all('img'):
-        img.decompose()
-    for tag in soup.find_all(['div', 'span']):
-        tag.unwrap()
-    for p in soup.find_all('p'):
-        p.replace_with('\n\n' + p.get_text(strip=True))
-    for br in soup.find_all('br'):
-        br.replace_with('\n')
-    for strong in soup.find_all('strong'):
-        strong.name = 'b'
-    for em in soup.find_all('em'):
-        em.name = 'i'
-    return str(soup)
-
-def get_first_image_url(html_content):
-    soup = BeautifulSoup(html_content, 'html.parser')
-    img = soup.find('img')
-    if img and 'src' in img.attrs:
-        return img['src']
-    return None
-
-async def send_to_telegram(bot: Bot, channel_id: str, new_title: str, description: str, article_url: str):
-    try:
-        img_url = get_first_image_url(description)
-        
-        # Кликабельный заголовок
-        linked_title = f'<b><a href="{article_url}">{new_title}</a></b>'
-        
-        # Очищаем описание и разбиваем на абзацы
-        clean_desc = clean_description_for_telegram(description)
-        paragraphs = [p.strip() for p in clean_desc.split('\n\n') if p.strip()]
-        
-        # Начинаем формировать подпись: заголовок + абзацы по одному, пока влезаем
-        caption_parts = [linked_title]
-        current_length = len(linked_title) + 2  # +2 за переносы
-        
-        max_caption_length = 950  # безопасный лимит
-        
-        for para in paragraphs:
-            # Добавляем абзац с двумя переносами
-            test_length = current_length + len(para) + 2
-            if test_length > max_caption_length:
-                break
-            caption_parts.append(para)
-            current_length = test_length
-        
-        # Если обрезали — добавляем "Читать дальше" как ссылку
-        if len(caption_parts) < len(paragraphs) + 1:  # +1 потому что заголовок уже есть
-            caption_parts.append(f'\n\n<tg-spoiler>… <a href="{article_url}">Читать дальше на Habr</a></tg-spoiler>')
-        
-        caption = '\n\n'.join(caption_parts)
-        
-        # Отправляем фото с подписью (или просто текст, если нет фото)
-        if img_url:
-            await bot.send_photo(
-                chat_id=channel_id,
-                photo=img_url,
-                caption=caption,
-                parse_mode=ParseMode.HTML
+# Сколько запросов к Groq может выполняться одновременно
+GROQ_CONCURRENCY = max(1, int(os.getenv('GROQ_CONCURRENCY', '4')))
+GROQ_MODEL = os.getenv('GROQ_MODEL', 'meta-llama/llama-4-maverick-17b-128e-instruct')
+
+OPENAI_BASE_URL = os.getenv('OPENAI_BASE_URL')
+OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+OPENAI_MODEL = os.getenv('OPENAI_MODEL', 'gpt-4o-mini')
+OPENAI_CONCURRENCY = max(1, int(os.getenv('OPENAI_CONCURRENCY', '4')))
+
+AMVERA_API_TOKEN = os.getenv('AMVERA_API_TOKEN')
+AMVERA_ENDPOINT = os.getenv('AMVERA_ENDPOINT', 'https://kong-proxy.yc.amvera.ru/api/v1/models/deepseek')
+AMVERA_MODEL = os.getenv('AMVERA_MODEL', 'deepseek-V3')
+AMVERA_CONCURRENCY = max(1, int(os.getenv('AMVERA_CONCURRENCY', '4')))
+
+RSS_URL = os.getenv('RSS_URL', 'https://habr.com/ru/rss/articles/?fl=ru')
+
+# Очередь Telegram: общий лимит бота (сообщений в секунду) и лимит на один канал (в минуту)
+TELEGRAM_RATE_GLOBAL = float(os.getenv('TELEGRAM_RATE_GLOBAL', '25'))
+TELEGRAM_RATE_PER_CHAT = float(os.getenv('TELEGRAM_RATE_PER_CHAT', '18'))
+TELEGRAM_MAX_ATTEMPTS = int(os.getenv('TELEGRAM_MAX_ATTEMPTS', '8'))
+# Сколько --once ждёт отложенные посты перед выходом; остальное уйдёт в следующий запуск
+TELEGRAM_DRAIN_WAIT = float(os.getenv('TELEGRAM_DRAIN_WAIT', '90'))
+
+# Общий HTTP-клиент: у каждого известного хоста (лента, LLM, Telegram) свой пул соединений
+HTTP_MAX_CONNECTIONS = max(1, int(os.getenv('HTTP_MAX_CONNECTIONS', '32')))
+HTTP_MAX_CONNECTIONS_PER_HOST = max(1, int(os.getenv('HTTP_MAX_CONNECTIONS_PER_HOST', '8')))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '10'))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv('HTTP_KEEPALIVE_EXPIRY', '60'))
+
+# Картинки для send_photo: сколько качать одновременно, сколько максимум качать,
+# до какого размера и длинной стороны пережимать и сколько дней помнить результат
+IMAGE_CONCURRENCY = max(1, int(os.getenv('IMAGE_CONCURRENCY', '4')))
+IMAGE_MAX_DOWNLOAD = int(os.getenv('IMAGE_MAX_DOWNLOAD', str(20 * 1024 * 1024)))
+IMAGE_MAX_BYTES = int(os.getenv('IMAGE_MAX_BYTES', str(5 * 1024 * 1024)))
+IMAGE_MAX_SIDE = int(os.getenv('IMAGE_MAX_SIDE', '2560'))
+IMAGE_CACHE_DAYS = int(os.getenv('IMAGE_CACHE_DAYS', '30'))
+
+# Архив переписанных статей по RFC 5005: сколько последних держать в основной ленте,
+# по сколько складывать в страницы архива и с каким префиксом ссылаться на них
+# (по умолчанию — относительные ссылки). ARCHIVE_ITEMS=0 — зеркалить только текущее окно ленты
+ARCHIVE_ITEMS = int(os.getenv('ARCHIVE_ITEMS', '100'))
+ARCHIVE_PAGE_SIZE = max(1, int(os.getenv('ARCHIVE_PAGE_SIZE', '50')))
+ARCHIVE_BASE_URL = os.getenv('ARCHIVE_BASE_URL', '')
+
+# Метрики: порт для /metrics в режиме --daemon (0 — не поднимать) и сводка запуска для --once
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+# Адрес для /metrics: 0.0.0.0 нужен в Docker, 127.0.0.1 — чтобы не светить метрики наружу
+METRICS_HOST = os.getenv('METRICS_HOST', '0.0.0.0')
+RUN_SUMMARY_FILE = os.getenv('RUN_SUMMARY_FILE', 'run_summary.json')
+
+# Бюджет одного прохода, секунды (0 — без ограничения). Новые статьи обрабатываются от свежих
+# к старым волнами по RUN_WAVE штук; что не успело до дедлайна, откладывается до следующего прохода.
+# Отложенные статьи попадают в архив ленты позже более свежих (см. FeedArchive)
+RUN_BUDGET = float(os.getenv('RUN_BUDGET', '2700'))
+RUN_WAVE = max(1, int(os.getenv('RUN_WAVE', '20')))
+
+# Режим --daemon: интервал опроса ленты и случайный разброс, секунды
+POLL_INTERVAL = float(os.getenv('POLL_INTERVAL', '300'))
+POLL_JITTER = float(os.getenv('POLL_JITTER', '30'))
+
+# Бэкфилл старых статей: сколько страниц качать одновременно, сколько запросов в секунду
+# делать к одному хосту, сколько раз повторять неудачную страницу и где остановиться.
+# BACKFILL_URL — шаблон адреса страницы с {page}; без него к URL ленты добавляется ?page=N
+BACKFILL_CONCURRENCY = max(1, int(os.getenv('BACKFILL_CONCURRENCY', '4')))
+BACKFILL_HOST_RATE = float(os.getenv('BACKFILL_HOST_RATE', '1'))
+BACKFILL_ATTEMPTS = max(1, int(os.getenv('BACKFILL_ATTEMPTS', '3')))
+BACKFILL_MAX_PAGES = int(os.getenv('BACKFILL_MAX_PAGES', '50'))
+BACKFILL_URL = os.getenv('BACKFILL_URL')
+
+# Реестр лент: JSON-список {"name", "url", "output", "channel_id"} в папке данных.
+# Без него работает одна лента из RSS_URL, RSS_OUTPUT_FILE и TELEGRAM_CHANNEL_ID.
+FEEDS_FILE = os.getenv('FEEDS_FILE', 'feeds.json')
+
+ARTICLES_FILE = 'articles.json'  # старый формат, переносится в ARTICLES_DB один раз
+ARTICLES_DB = 'articles.db'
+FEED_CACHE_FILE = 'feed_cache.json'
+# Блокировка запуска: второй процесс с той же папкой данных не стартует
+LOCK_FILE = 'honest-habr.lock'
+
+# Ограничения хранения обработанных статей (0 — без ограничений)
+ARTICLES_MAX_ITEMS = int(os.getenv('ARTICLES_MAX_ITEMS', '0'))
+ARTICLES_MAX_AGE_DAYS = int(os.getenv('ARTICLES_MAX_AGE_DAYS', '0'))
+
+# Сколько статей отправлять в одном запросе к LLM (1 — по одной); нужен prompt_batch.txt —
+# обёртка, в которую вместо {{RULES}} подставляются правила стиля из prompt.txt
+LLM_BATCH_SIZE = max(1, int(os.getenv('LLM_BATCH_SIZE', '1')))
+
+# Перепечатки: статьи, у которых SimHash описаний отличается не больше чем на DEDUP_MAX_DISTANCE
+# бит из 64, считаются одной (-1 — не искать). Описания короче DEDUP_MIN_WORDS слов не сравниваются
+DEDUP_MAX_DISTANCE = min(15, int(os.getenv('DEDUP_MAX_DISTANCE', '6')))
+DEDUP_MIN_WORDS = int(os.getenv('DEDUP_MIN_WORDS', '10'))
+
+# Сколько ответов LLM хранить в кэше (0 — без ограничения)
+LLM_CACHE_MAX_ENTRIES = int(os.getenv('LLM_CACHE_MAX_ENTRIES', '10000'))
+
+class Metrics:
+    """Счётчики и длительности этапов пайплайна.
+
+    Счётчики накапливаются за всё время жизни процесса (для Prometheus в --daemon),
+    длительности хранятся последними SAMPLES значениями на этап для квантилей.
+    """
+
+    SAMPLES = 1000
+    QUANTILES = (0.5, 0.9, 0.99)
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.timings = {}
+        self.started = time.time()
+
+    @staticmethod
+    def _key(name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        self.gauges[self._key(name, labels)] = value
+
+    def observe(self, stage, seconds):
+        timing = self.timings.get(stage)
+        if timing is None:
+            timing = self.timings[stage] = {'count': 0, 'sum': 0.0, 'samples': deque(maxlen=self.SAMPLES)}
+        timing['count'] += 1
+        timing['sum'] += seconds
+        timing['samples'].append(seconds)
+
+    @contextmanager
+    def span(self, stage):
+        """Замер этапа: with metrics.span('fetch'): ..."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def _quantiles(self, samples):
+        ordered = sorted(samples)
+        return {q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] for q in self.QUANTILES}
+
+    @staticmethod
+    def _escape(value):
+        """Значение метки по правилам формата Prometheus: \\, \" и перевод строки экранируются."""
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    @classmethod
+    def _labels(cls, labels):
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{k}="{cls._escape(v)}"' for k, v in labels) + '}'
+
+    def render_prometheus(self):
+        lines = []
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append(f'honest_habr_{name}_total{self._labels(labels)} {value}')
+        for (name, labels), value in sorted(self.gauges.items()):
+            lines.append(f'honest_habr_{name}{self._labels(labels)} {value}')
+        if self.timings:
+            lines.append('# TYPE honest_habr_stage_seconds summary')
+        for stage, timing in sorted(self.timings.items()):
+            for q, value in self._quantiles(timing['samples']).items():
+                lines.append(f'honest_habr_stage_seconds{self._labels((("stage", stage), ("quantile", q)))} {value:.6f}')
+            lines.append(f'honest_habr_stage_seconds_sum{self._labels((("stage", stage),))} {timing["sum"]:.6f}')
+            lines.append(f'honest_habr_stage_seconds_count{self._labels((("stage", stage),))} {timing["count"]}')
+        lines.append(f'honest_habr_uptime_seconds {time.time() - self.started:.3f}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        def name(key):
+            base, labels = key
+            return base + ''.join(f'[{k}={v}]' for k, v in labels)
+
+        return {
+            'started_at': self.started,
+            'duration': time.time() - self.started,
+            'counters': {name(key): value for key, value in sorted(self.counters.items())},
+            'gauges': {name(key): value for key, value in sorted(self.gauges.items())},
+            'stages': {
+                stage: {
+                    'count': timing['count'],
+                    'sum': timing['sum'],
+                    **{f'p{int(q * 100)}': value for q, value in self._quantiles(timing['samples']).items()},
+                }
+                for stage, timing in sorted(self.timings.items())
+            },
+        }
+
+metrics = Metrics()
+
+async def serve_metrics(host, port):
+    """Минимальный HTTP-сервер с одной страницей /metrics в формате Prometheus."""
+    async def handle(reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            # Заголовки запроса не нужны, но их надо дочитать
+            while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status, body = '200 OK', metrics.render_prometheus().encode('utf-8')
+            else:
+                status, body = '404 Not Found', b'not found\n'
+            writer.write(
+                f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode('latin-1') + body
             )
+            await writer.drain()
+        except Exception:
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    logger.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return server
+
+def write_run_summary(app_path):
+    path = os.path.join(app_path, RUN_SUMMARY_FILE)
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(metrics.summary(), f, ensure_ascii=False, indent=4)
+    os.replace(tmp, path)
+
+class PreparedEntry(NamedTuple):
+    """Всё, что пайплайну нужно от HTML статьи, после одного разбора."""
+    title: str              # заголовок без разметки
+    description: str        # описание без разметки (для промпта)
+    image_url: Optional[str]  # первая картинка из описания
+    paragraphs: List[str]   # абзацы описания в HTML, который понимает Telegram
+
+# Теги, которые Telegram принимает в parse_mode=HTML, после переименований
+TELEGRAM_RENAMES = {'strong': 'b', 'em': 'i'}
+VOID_TAGS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'source', 'track', 'wbr'}
+
+def _parse_fragment(html_content):
+    return lxml.html.fragment_fromstring(html_content, create_parent='div')
+
+def _plain_text(root, separator=' '):
+    return separator.join(t.strip() for t in root.itertext() if t.strip())
+
+def _escape_attr(value):
+    return html.escape(value, quote=False).replace('"', '&quot;')
+
+def _render_telegram(elem, out):
+    """Рендер поддерева для Telegram: без картинок, div/span разворачиваются, <p> становится текстом."""
+    for child in elem:
+        if not isinstance(child.tag, str):
+            # комментарии и инструкции обработки пропускаем, хвост оставляем
+            pass
+        elif child.tag == 'img':
+            pass
+        elif child.tag in ('div', 'span'):
+            if child.text:
+                out.append(html.escape(child.text, quote=False))
+            _render_telegram(child, out)
+        elif child.tag == 'p':
+            out.append('\n\n' + html.escape(_plain_text(child, ''), quote=False))
+        elif child.tag == 'br':
+            out.append('\n')
         else:
-            # Если нет фото — можно чуть больше текста, но всё равно обрезаем красиво
-            if len(caption) > 4000:
-                caption = caption[:4000] + f'\n\n<tg-spoiler>… <a href="{article_url}">Читать дальше</a></tg-spoiler>'
-            await bot.send_message(
-                chat_id=channel_id,
-                text=caption,
-                parse_mode=ParseMode.HTML,
-                disable_web_page_preview=True
+            tag = TELEGRAM_RENAMES.get(child.tag, child.tag)
+            attrs = ''.join(f' {k}="{_escape_attr(v)}"' for k, v in child.attrib.items())
+            if tag in VOID_TAGS:
+                out.append(f'<{tag}{attrs}/>')
+            else:
+                out.append(f'<{tag}{attrs}>')
+                if child.text:
+                    out.append(html.escape(child.text, quote=False))
+                _render_telegram(child, out)
+                out.append(f'</{tag}>')
+        if child.tail:
+            out.append(html.escape(child.tail, quote=False))
+
+def clean_text(html_content):
+    if not html_content or not html_content.strip():
+        return ''
+    # Обычный заголовок без разметки незачем разбирать
+    if '<' not in html_content and '&' not in html_content:
+        return html_content.strip()
+    return _plain_text(_parse_fragment(html_content))
+
+def preprocess_entry(old_title, description):
+    """Один разбор описания lxml'ом вместо трёх-четырёх проходов BeautifulSoup."""
+    if not description or not description.strip():
+        return PreparedEntry(clean_text(old_title), '', None, [])
+
+    root = _parse_fragment(description)
+
+    image_url = None
+    for img in root.iter('img'):
+        image_url = img.get('src')
+        break
+
+    out = [html.escape(root.text, quote=False)] if root.text else []
+    _render_telegram(root, out)
+    paragraphs = [p.strip() for p in ''.join(out).split('\n\n') if p.strip()]
+
+    return PreparedEntry(clean_text(old_title), _plain_text(root), image_url, paragraphs)
+
+class ArticleStore:
+    """Обработанные статьи в SQLite с ключом guid.
+
+    Проверка «уже обработана?» идёт по первичному ключу, новые статьи
+    дописываются по одной, поэтому время запуска не растёт вместе с историей.
+    """
+
+    # Сколько guid передавать в один запрос IN (...), лимит SQLite — 999 параметров
+    CHUNK = 500
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        # auto_vacuum действует только для новой базы, поэтому ставим его до CREATE TABLE
+        self.conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS articles ('
+            ' guid TEXT PRIMARY KEY,'
+            ' old_title TEXT NOT NULL,'
+            ' new_title TEXT NOT NULL,'
+            ' created_at REAL NOT NULL'
+            ') WITHOUT ROWID'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS articles_created_at ON articles (created_at)')
+        # Очередь постов в Telegram; status: pending → sent или failed,
+        # skipped — перепечатка уже отправленной статьи, её не отправляем
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS outbox ('
+            ' id INTEGER PRIMARY KEY AUTOINCREMENT,'
+            ' guid TEXT NOT NULL,'
+            ' chat_id TEXT NOT NULL,'
+            ' payload TEXT NOT NULL,'
+            " status TEXT NOT NULL DEFAULT 'pending',"
+            ' attempts INTEGER NOT NULL DEFAULT 0,'
+            ' next_attempt_at REAL NOT NULL,'
+            ' last_error TEXT,'
+            ' created_at REAL NOT NULL,'
+            ' UNIQUE (guid, chat_id)'
+            ')'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS outbox_chat ON outbox (chat_id, status, id)')
+        self.conn.commit()
+
+    def __contains__(self, guid):
+        return self.conn.execute('SELECT 1 FROM articles WHERE guid = ?', (guid,)).fetchone() is not None
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM articles').fetchone()[0]
+
+    def get(self, guid):
+        row = self.conn.execute(
+            'SELECT guid, old_title, new_title FROM articles WHERE guid = ?', (guid,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {'guid': row[0], 'old_title': row[1], 'new_title': row[2]}
+
+    def titles(self, guids):
+        """Новые заголовки для тех guid из списка, что уже есть в базе."""
+        guids = list(dict.fromkeys(guids))
+        result = {}
+        for i in range(0, len(guids), self.CHUNK):
+            chunk = guids[i:i + self.CHUNK]
+            placeholders = ','.join('?' * len(chunk))
+            for guid, new_title in self.conn.execute(
+                f'SELECT guid, new_title FROM articles WHERE guid IN ({placeholders})', chunk
+            ):
+                result[guid] = new_title
+        return result
+
+    def add(self, guid, old_title, new_title, posts=(), created_at=None, skipped=()):
+        """Сохраняет статью и в той же транзакции ставит её посты (chat_id, post) в очередь.
+
+        skipped — каналы, куда статью не отправляем; они отмечаются в outbox, чтобы
+        статья не ушла туда и позже, при повторной встрече в другой ленте.
+        """
+        now = time.time()
+        with self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO articles (guid, old_title, new_title, created_at) VALUES (?, ?, ?, ?)',
+                (guid, old_title, new_title, created_at if created_at is not None else now)
             )
-        
-        logger.info("Успешно отправлено в Telegram (компактная версия)")
-    
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO outbox (guid, chat_id, payload, next_attempt_at, created_at) VALUES (?, ?, ?, ?, ?)',
+                [(guid, str(chat_id), json.dumps(post, ensure_ascii=False), now, now) for chat_id, post in posts]
+            )
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO outbox (guid, chat_id, payload, status, next_attempt_at, created_at)"
+                " VALUES (?, ?, '{}', 'skipped', ?, ?)",
+                [(guid, str(chat_id), now, now) for chat_id in skipped]
+            )
+
+    def posted(self, guids, chat_id):
+        """Какие из guid уже стоят в очереди или отправлены в chat_id."""
+        guids = list(dict.fromkeys(guids))
+        result = set()
+        for i in range(0, len(guids), self.CHUNK):
+            chunk = guids[i:i + self.CHUNK]
+            placeholders = ','.join('?' * len(chunk))
+            for (guid,) in self.conn.execute(
+                f'SELECT guid FROM outbox WHERE chat_id = ? AND guid IN ({placeholders})', [str(chat_id)] + chunk
+            ):
+                result.add(guid)
+        return result
+
+    def enqueue(self, guid, chat_id, post):
+        now = time.time()
+        with self.conn:
+            self.conn.execute(
+                'INSERT OR IGNORE INTO outbox (guid, chat_id, payload, next_attempt_at, created_at) VALUES (?, ?, ?, ?, ?)',
+                (guid, str(chat_id), json.dumps(post, ensure_ascii=False), now, now)
+            )
+
+    def outbox_due(self, now, limit=50, per_chat=5):
+        """Посты, которые пора отправить: не больше per_chat старейших от каждого чата.
+
+        Сначала идут первые посты всех чатов, затем вторые и так далее, поэтому
+        большая очередь одного канала не вытесняет из выборки остальные. Пост не
+        выдаётся, пока более ранний пост того же чата отложен: канал получает статьи
+        в том порядке, в каком они встали в очередь.
+        """
+        return self.conn.execute(
+            "SELECT id, chat_id, payload, attempts FROM ("
+            " SELECT id, chat_id, payload, attempts,"
+            "  ROW_NUMBER() OVER (PARTITION BY chat_id ORDER BY id) AS position"
+            " FROM outbox o"
+            " WHERE status = 'pending' AND next_attempt_at <= ? AND NOT EXISTS ("
+            "  SELECT 1 FROM outbox p WHERE p.chat_id = o.chat_id AND p.status = 'pending'"
+            "  AND p.id < o.id AND p.next_attempt_at > ?"
+            " )"
+            ") WHERE position <= ? ORDER BY position, id LIMIT ?",
+            (now, now, per_chat, limit)
+        ).fetchall()
+
+    def outbox_next_attempt(self, after=None):
+        """Время ближайшей попытки среди ожидающих постов; after — только позже этого момента."""
+        if after is None:
+            return self.conn.execute("SELECT MIN(next_attempt_at) FROM outbox WHERE status = 'pending'").fetchone()[0]
+        return self.conn.execute(
+            "SELECT MIN(next_attempt_at) FROM outbox WHERE status = 'pending' AND next_attempt_at > ?", (after,)
+        ).fetchone()[0]
+
+    def outbox_pending(self):
+        return self.conn.execute("SELECT COUNT(*) FROM outbox WHERE status = 'pending'").fetchone()[0]
+
+    def outbox_sent(self, post_id):
+        with self.conn:
+            self.conn.execute("UPDATE outbox SET status = 'sent', last_error = NULL WHERE id = ?", (post_id,))
+
+    def outbox_retry(self, post_id, delay, error, count_attempt=True):
+        with self.conn:
+            self.conn.execute(
+                'UPDATE outbox SET attempts = attempts + ?, next_attempt_at = ?, last_error = ? WHERE id = ?',
+                (1 if count_attempt else 0, time.time() + delay, error, post_id)
+            )
+
+    def outbox_fail(self, post_id, error):
+        with self.conn:
+            self.conn.execute(
+                "UPDATE outbox SET status = 'failed', attempts = attempts + 1, last_error = ? WHERE id = ?",
+                (error, post_id)
+            )
+
+    def migrate_json(self, json_path, posted_to=None):
+        """Одноразовый перенос articles.json; файл переименовывается в *.migrated.
+
+        Статьи из старой базы уже были отправлены в posted_to, это отмечается в outbox,
+        чтобы их не разослали повторно.
+        """
+        if not os.path.exists(json_path):
+            return 0
+        with open(json_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        now = time.time()
+        rows = [
+            (guid, item.get('old_title', ''), item.get('new_title', ''), now)
+            for guid, item in data.items()
+            if isinstance(item, dict) and item.get('new_title')
+        ]
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO articles (guid, old_title, new_title, created_at) VALUES (?, ?, ?, ?)',
+                rows
+            )
+            if posted_to:
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO outbox (guid, chat_id, payload, status, next_attempt_at, created_at)"
+                    " VALUES (?, ?, '{}', 'sent', ?, ?)",
+                    [(guid, str(posted_to), now, now) for guid, _, _, _ in rows]
+                )
+        os.replace(json_path, json_path + '.migrated')
+        return len(rows)
+
+    def prune(self, max_items=0, max_age_days=0):
+        """Удаляет старые записи по возрасту и/или количеству и возвращает место на диске."""
+        removed = 0
+        with self.conn:
+            if max_age_days > 0:
+                cutoff = time.time() - max_age_days * 86400
+                removed += self.conn.execute('DELETE FROM articles WHERE created_at < ?', (cutoff,)).rowcount
+            if max_items > 0:
+                removed += self.conn.execute(
+                    'DELETE FROM articles WHERE guid IN ('
+                    ' SELECT guid FROM articles ORDER BY created_at DESC LIMIT -1 OFFSET ?'
+                    ')', (max_items,)
+                ).rowcount
+            # Отправленные посты больше не нужны, если статьи уже нет в базе
+            self.conn.execute(
+                "DELETE FROM outbox WHERE status != 'pending' AND guid NOT IN (SELECT guid FROM articles)"
+            )
+        if removed:
+            self.conn.execute('PRAGMA incremental_vacuum')
+        return removed
+
+    def close(self):
+        self.conn.close()
+
+def open_article_store(app_path):
+    store = ArticleStore(os.path.join(app_path, ARTICLES_DB))
+    json_path = os.path.join(app_path, ARTICLES_FILE)
+    if os.path.exists(json_path):
+        try:
+            migrated = store.migrate_json(json_path, posted_to=TELEGRAM_CHANNEL_ID)
+            logger.info(f"Перенесено {migrated} статей из {ARTICLES_FILE} в {ARTICLES_DB}")
+        except Exception as e:
+            logger.error(f"Ошибка переноса {ARTICLES_FILE}: {e}")
+    return store
+
+class LLMCache:
+    """Дисковый LRU-кэш ответов LLM в той же базе SQLite.
+
+    Ключ — хэш (модель, хэш шаблона промпта, очищенный заголовок, очищенное описание),
+    поэтому статья, перевыпущенная с новым guid, или повтор после падения не стоят
+    повторного запроса. При превышении max_entries вытесняются давно не использованные.
+    """
+
+    def __init__(self, conn, max_entries):
+        self.conn = conn
+        self.max_entries = max_entries
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS llm_cache ('
+            ' key TEXT PRIMARY KEY,'
+            ' value TEXT NOT NULL,'
+            ' used_at REAL NOT NULL'
+            ') WITHOUT ROWID'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS llm_cache_used_at ON llm_cache (used_at)')
+        self.conn.commit()
+        self.size = self.conn.execute('SELECT COUNT(*) FROM llm_cache').fetchone()[0]
+
+    @staticmethod
+    def key(model, template_hash, title, description):
+        raw = json.dumps([model, template_hash, title, description], ensure_ascii=False)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        row = self.conn.execute('SELECT value FROM llm_cache WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        with self.conn:
+            self.conn.execute('UPDATE llm_cache SET used_at = ? WHERE key = ?', (time.time(), key))
+        return row[0]
+
+    def put(self, key, value):
+        with self.conn:
+            inserted = self.conn.execute(
+                'INSERT OR IGNORE INTO llm_cache (key, value, used_at) VALUES (?, ?, ?)', (key, value, time.time())
+            ).rowcount
+            if not inserted:
+                self.conn.execute(
+                    'UPDATE llm_cache SET value = ?, used_at = ? WHERE key = ?', (value, time.time(), key)
+                )
+            self.size += inserted
+            if self.max_entries > 0 and self.size > self.max_entries:
+                self.size -= self.conn.execute(
+                    'DELETE FROM llm_cache WHERE key IN ('
+                    ' SELECT key FROM llm_cache ORDER BY used_at LIMIT ?'
+                    ')', (self.size - self.max_entries,)
+                ).rowcount
+
+class ImageCache:
+    """Результат подготовки картинки по её URL, в той же базе SQLite.
+
+    status 'ok' — картинку можно отправлять: есть file_id Telegram или пережатые байты
+    (их храним только до первой успешной загрузки); 'unusable' — отправлять текстом.
+    Временные ошибки загрузки не запоминаются.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS images ('
+            ' url TEXT PRIMARY KEY,'
+            ' status TEXT NOT NULL,'
+            ' file_id TEXT,'
+            ' data BLOB,'
+            ' error TEXT,'
+            ' checked_at REAL NOT NULL'
+            ') WITHOUT ROWID'
+        )
+        self.conn.commit()
+
+    def get(self, url):
+        """(status, file_id, data) или None, если картинку ещё не проверяли."""
+        return self.conn.execute('SELECT status, file_id, data FROM images WHERE url = ?', (url,)).fetchone()
+
+    def put(self, url, status, data=None, error=None):
+        with self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO images (url, status, data, error, checked_at) VALUES (?, ?, ?, ?, ?)',
+                (url, status, data, error, time.time())
+            )
+
+    def set_file_id(self, url, file_id):
+        with self.conn:
+            self.conn.execute(
+                "UPDATE images SET status = 'ok', file_id = ?, data = NULL WHERE url = ?", (file_id, url)
+            )
+
+    def forget(self, url):
+        with self.conn:
+            self.conn.execute('DELETE FROM images WHERE url = ?', (url,))
+
+    def prune(self, max_age_days):
+        if max_age_days <= 0:
+            return 0
+        with self.conn:
+            return self.conn.execute(
+                'DELETE FROM images WHERE checked_at < ?', (time.time() - max_age_days * 86400,)
+            ).rowcount
+
+class FeedArchive:
+    """Переписанные <item> каждой выходной ленты в порядке появления, готовыми байтами.
+
+    seq растёт на единицу с каждой новой статьёй и не переиспользуется, поэтому
+    страница архива N — это ровно статьи с seq из ((N-1)*size, N*size]. seq отражает
+    момент обработки, а не публикации: статья, которая раньше не удалась или была
+    отложена RUN_BUDGET, получает seq больше, чем более свежие. Заполненные страницы
+    неизменны, поэтому такая статья попадает на текущую страницу, но внутри каждого
+    документа статьи упорядочены по pubDate (published), а без даты — по seq.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS feed_archive ('
+            ' feed TEXT NOT NULL,'
+            ' seq INTEGER NOT NULL,'
+            ' guid TEXT NOT NULL,'
+            ' item BLOB NOT NULL,'
+            ' added_at REAL NOT NULL,'
+            ' published REAL,'
+            ' PRIMARY KEY (feed, seq),'
+            ' UNIQUE (feed, guid)'
+            ') WITHOUT ROWID'
+        )
+        # Архивы, созданные до появления published: у старых статей даты не будет
+        columns = {row[1] for row in self.conn.execute('PRAGMA table_info(feed_archive)')}
+        if 'published' not in columns:
+            self.conn.execute('ALTER TABLE feed_archive ADD COLUMN published REAL')
+        self.conn.commit()
+
+    def add(self, feed, items, published=None):
+        """items — [(guid, байты <item>)] в порядке ленты, новые первыми; published — guid → pubDate
+        (unix-время). Возвращает число добавленных."""
+        published = published or {}
+        added = 0
+        now = time.time()
+        with self.conn:
+            seq = self.conn.execute('SELECT COALESCE(MAX(seq), 0) FROM feed_archive WHERE feed = ?', (feed,)).fetchone()[0]
+            # Старые первыми, чтобы seq рос вместе с новизной
+            for guid, item in reversed(items):
+                if self.conn.execute('SELECT 1 FROM feed_archive WHERE feed = ? AND guid = ?', (feed, guid)).fetchone():
+                    continue
+                seq += 1
+                self.conn.execute(
+                    'INSERT INTO feed_archive (feed, seq, guid, item, added_at, published) VALUES (?, ?, ?, ?, ?, ?)',
+                    (feed, seq, guid, item, now, published.get(guid))
+                )
+                added += 1
+        return added
+
+    def count(self, feed):
+        return self.conn.execute('SELECT COALESCE(MAX(seq), 0) FROM feed_archive WHERE feed = ?', (feed,)).fetchone()[0]
+
+    # Порядок внутри документа: по дате публикации, статьи без даты — в конце
+    ORDER = 'ORDER BY published IS NULL, published DESC, seq DESC'
+
+    def latest(self, feed, limit):
+        """limit последних добавленных статей, свежие по pubDate первыми."""
+        rows = self.conn.execute(
+            'SELECT item FROM (SELECT item, seq, published FROM feed_archive WHERE feed = ? ORDER BY seq DESC LIMIT ?) '
+            + self.ORDER, (feed, limit)
+        )
+        return [row[0] for row in rows]
+
+    def page(self, feed, number, size):
+        """Статьи страницы архива number (с 1), свежие по pubDate первыми."""
+        rows = self.conn.execute(
+            'SELECT item FROM feed_archive WHERE feed = ? AND seq > ? AND seq <= ? ' + self.ORDER,
+            (feed, (number - 1) * size, number * size)
+        )
+        return [row[0] for row in rows]
+
+WORD_RE = re.compile(r'\w{3,}')
+# Бит i байта — в 32-битную дорожку i: сумма таких чисел считает единицы во всех битах сразу
+_SIMHASH_LANES = [sum(((byte >> bit) & 1) << (32 * bit) for bit in range(8)) for byte in range(256)]
+_UINT64 = (1 << 64) - 1
+
+def simhash(text):
+    """64-битный SimHash множества слов текста; None — различных слов меньше DEDUP_MIN_WORDS."""
+    words = set(WORD_RE.findall(text.lower()))
+    if len(words) < max(1, DEDUP_MIN_WORDS):
+        return None
+    digests = b''.join(hashlib.blake2b(word.encode('utf-8'), digest_size=8).digest() for word in words)
+    half = len(words) // 2
+    value = 0
+    # Байт k всех хэшей — срез digests[k::8]; бит отпечатка ставится, если в столбце больше половины единиц
+    for position in range(8):
+        lanes = sum(map(_SIMHASH_LANES.__getitem__, digests[position::8]))
+        for bit in range(7, -1, -1):
+            value = (value << 1) | (((lanes >> (32 * bit)) & 0xFFFFFFFF) > half)
+    return value
+
+class SimilarityIndex:
+    """SimHash описаний сохранённых статей с LSH-корзинами в той же базе SQLite.
+
+    64 бита делятся на max_distance + 1 полос: у отпечатков, различающихся не больше
+    чем на max_distance бит, хотя бы одна полоса совпадает целиком. Поиск — выборка
+    по индексу корзин и popcount по немногим кандидатам.
+    """
+
+    def __init__(self, conn, max_distance):
+        self.conn = conn
+        self.max_distance = max_distance
+        bands = max_distance + 1
+        self.bands = []
+        shift = 0
+        for i in range(bands):
+            width = 64 // bands + (1 if i < 64 % bands else 0)
+            self.bands.append((shift, (1 << width) - 1))
+            shift += width
+        # Номера полос зависят от их числа: корзины прошлой настройки не мешают новой
+        self.base = bands * 100
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS simhash ('
+            ' guid TEXT PRIMARY KEY,'
+            ' hash INTEGER NOT NULL'
+            ') WITHOUT ROWID'
+        )
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS simhash_bands ('
+            ' band INTEGER NOT NULL,'
+            ' value INTEGER NOT NULL,'
+            ' guid TEXT NOT NULL,'
+            ' hash INTEGER NOT NULL,'
+            ' PRIMARY KEY (band, value, guid)'
+            ') WITHOUT ROWID'
+        )
+        self.conn.commit()
+        self._rebuild()
+
+    def _keys(self, fingerprint):
+        return [(self.base + i, (fingerprint >> shift) & mask) for i, (shift, mask) in enumerate(self.bands)]
+
+    def _rebuild(self):
+        """Пересобирает корзины, если DEDUP_MAX_DISTANCE поменялся с прошлого запуска."""
+        current = self.conn.execute(
+            'SELECT 1 FROM simhash_bands WHERE band >= ? AND band < ? LIMIT 1', (self.base, self.base + 100)
+        ).fetchone()
+        if current or not self.conn.execute('SELECT 1 FROM simhash LIMIT 1').fetchone():
+            return
+        rows = self.conn.execute('SELECT guid, hash FROM simhash').fetchall()
+        with self.conn:
+            self.conn.execute('DELETE FROM simhash_bands')
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO simhash_bands (band, value, guid, hash) VALUES (?, ?, ?, ?)',
+                [(band, value, guid, stored) for guid, stored in rows for band, value in self._keys(stored & _UINT64)]
+            )
+        logger.info(f"Корзины поиска перепечаток пересобраны для {len(rows)} статей")
+
+    def find(self, fingerprint):
+        """(guid, заголовок) ближайшей сохранённой статьи не дальше max_distance бит или None."""
+        keys = self._keys(fingerprint)
+        # Отпечаток хранится и в корзинах: кандидаты проверяются без обращения к другим таблицам
+        rows = self.conn.execute(
+            'SELECT guid, hash FROM simhash_bands WHERE ' + ' OR '.join(['(band = ? AND value = ?)'] * len(keys)),
+            [item for key in keys for item in key]
+        )
+        matches = sorted(
+            (distance, guid) for guid, stored in rows
+            if (distance := ((stored & _UINT64) ^ fingerprint).bit_count()) <= self.max_distance
+        )
+        for _, guid in matches:
+            row = self.conn.execute('SELECT new_title FROM articles WHERE guid = ?', (guid,)).fetchone()
+            if row:
+                return guid, row[0]
+        return None
+
+    def add(self, guid, fingerprint):
+        # SQLite хранит знаковые 64-битные числа
+        stored = fingerprint - (1 << 64) if fingerprint >> 63 else fingerprint
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO simhash (guid, hash) VALUES (?, ?)', (guid, stored))
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO simhash_bands (band, value, guid, hash) VALUES (?, ?, ?, ?)',
+                [(band, value, guid, stored) for band, value in self._keys(fingerprint)]
+            )
+
+    def prune(self):
+        """Забывает отпечатки статей, которых больше нет в базе."""
+        with self.conn:
+            self.conn.execute('DELETE FROM simhash_bands WHERE guid NOT IN (SELECT guid FROM articles)')
+            return self.conn.execute('DELETE FROM simhash WHERE guid NOT IN (SELECT guid FROM articles)').rowcount
+
+class BackfillCheckpoint:
+    """Страницы бэкфилла, все статьи которых уже сохранены, в той же базе SQLite.
+
+    job — хэш адреса и диапазона дат. Воркеры заканчивают страницы не по порядку, а
+    неудачная страница пропускается, поэтому отмеченные страницы идут с дырами. Повторный
+    запуск пропускает только страницы до первой дыры (watermark): новые статьи сдвигают
+    старые к следующим страницам, и хвост недокачанной страницы мог уехать на
+    отмеченную после неё. Всё после дыры проходится заново, а уже сохранённое
+    отсекается по guid без обращения к LLM.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS backfill_pages ('
+            ' job TEXT NOT NULL,'
+            ' page INTEGER NOT NULL,'
+            ' articles INTEGER NOT NULL,'
+            ' done_at REAL NOT NULL,'
+            ' PRIMARY KEY (job, page)'
+            ') WITHOUT ROWID'
+        )
+        self.conn.commit()
+
+    def watermark(self, job):
+        """Номер последней страницы, до которой пройдены все страницы подряд (0 — ни одной)."""
+        pages = {page for (page,) in self.conn.execute('SELECT page FROM backfill_pages WHERE job = ?', (job,))}
+        number = 0
+        while number + 1 in pages:
+            number += 1
+        return number
+
+    def mark(self, job, page, articles):
+        with self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO backfill_pages (job, page, articles, done_at) VALUES (?, ?, ?, ?)',
+                (job, page, articles, time.time())
+            )
+
+    def reset(self, job):
+        with self.conn:
+            return self.conn.execute('DELETE FROM backfill_pages WHERE job = ?', (job,)).rowcount
+
+class FeedConfig(NamedTuple):
+    name: str
+    url: str
+    output: str               # файл переписанной ленты в папке данных
+    channel_id: Optional[str]  # канал Telegram; None — не постить
+
+def load_feeds(app_path):
+    """Читает реестр лент из FEEDS_FILE; без него — одна лента из переменных окружения."""
+    path = os.path.join(app_path, FEEDS_FILE)
+    if not os.path.exists(path):
+        if not TELEGRAM_CHANNEL_ID:
+            raise ValueError(f"Нет {FEEDS_FILE} и не задан TELEGRAM_CHANNEL_ID")
+        return [FeedConfig('habr', RSS_URL, RSS_OUTPUT_FILE, TELEGRAM_CHANNEL_ID)]
+
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    if not isinstance(data, list) or not data:
+        raise ValueError(f"{FEEDS_FILE} должен содержать непустой список лент")
+
+    feeds = []
+    for item in data:
+        if not isinstance(item, dict) or not item.get('url') or not item.get('output'):
+            raise ValueError(f"У каждой ленты в {FEEDS_FILE} должны быть url и output: {item!r}")
+        name = item.get('name') or item['url']
+        channel_id = item['channel_id'] if 'channel_id' in item else TELEGRAM_CHANNEL_ID
+        feeds.append(FeedConfig(name, item['url'], item['output'], str(channel_id) if channel_id else None))
+
+    for attr in ('name', 'output'):
+        values = [getattr(feed, attr) for feed in feeds]
+        if len(set(values)) != len(values):
+            raise ValueError(f"Повторяющиеся {attr} в {FEEDS_FILE}")
+    return feeds
+
+def load_feed_cache(path):
+    """Валидаторы прошлых загрузок лент по URL: ETag, Last-Modified и хэш тела."""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            cache = json.load(f)
+        if not isinstance(cache, dict):
+            return {}
+        # Старый формат — валидаторы единственной ленты
+        if 'sha256' in cache:
+            return {cache.get('url'): cache}
+        return cache
+    except FileNotFoundError:
+        return {}
     except Exception as e:
-        logger.error(f"Ошибка отправки в Telegram: {e}")
-                        
-async def main_async():
-    logger.info("Запуск сервиса...")
+        logger.error(f"Ошибка чтения {FEED_CACHE_FILE}: {e}")
+        return {}
 
-    if not all([GROQ_API_KEY, TELEGRAM_BOT_TOKEN, TELEGRAM_CHANNEL_ID]):
-        logger.error("Отсутствуют обязательные переменные окружения.")
-        return
+def save_feed_cache(path, cache):
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(cache, f, ensure_ascii=False, indent=4)
+    os.replace(tmp, path)
+
+# Таймауты по назначению запроса; Telegram передаёт свои через TelegramRequest
+FEED_TIMEOUT = httpx.Timeout(30, connect=HTTP_CONNECT_TIMEOUT)
+TELEGRAM_TIMEOUT = httpx.Timeout(15, connect=HTTP_CONNECT_TIMEOUT, pool=10)
+TELEGRAM_MEDIA_WRITE_TIMEOUT = 30
+IMAGE_TIMEOUT = httpx.Timeout(20, connect=HTTP_CONNECT_TIMEOUT)
+
+def build_http_client(hosts):
+    """Один AsyncClient на весь процесс: keep-alive, HTTP/2, если установлен h2.
+
+    Для каждого хоста из hosts заводится отдельный пул на HTTP_MAX_CONNECTIONS_PER_HOST
+    соединений, чтобы медленная лента не занимала соединения LLM и Telegram.
+    """
+    http2 = importlib.util.find_spec('h2') is not None
+    # Загрузка сертификатов — самая дорогая часть транспорта, контекст общий на все пулы
+    ssl_context = httpx.create_ssl_context()
+
+    def transport(max_connections):
+        return httpx.AsyncHTTPTransport(
+            verify=ssl_context,
+            http2=http2,
+            retries=1,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            ),
+        )
+
+    mounts = {f'all://{host}': transport(HTTP_MAX_CONNECTIONS_PER_HOST) for host in sorted(set(hosts)) if host}
+    return httpx.AsyncClient(
+        transport=transport(HTTP_MAX_CONNECTIONS),
+        mounts=mounts,
+        timeout=httpx.Timeout(30, connect=HTTP_CONNECT_TIMEOUT),
+        follow_redirects=True,
+    )
+
+def build_bot(http: httpx.AsyncClient):
+    """Bot поверх общего HTTP-клиента; python-telegram-bot импортируется только здесь."""
+    from telegram import Bot
+    from telegram.error import NetworkError, TimedOut
+    from telegram.request import BaseRequest, RequestData
+
+    class TelegramRequest(BaseRequest):
+        """Транспорт python-telegram-bot поверх общего httpx-клиента.
+
+        Повторяет HTTPXRequest, но не владеет клиентом: закрывает его Service.
+        """
+
+        def __init__(self, client: httpx.AsyncClient):
+            self.client = client
+
+        @property
+        def read_timeout(self):
+            return TELEGRAM_TIMEOUT.read
+
+        async def initialize(self):
+            pass
+
+        async def shutdown(self):
+            pass
+
+        async def do_request(self, url, method, request_data: Optional[RequestData] = None,
+                             read_timeout=BaseRequest.DEFAULT_NONE, write_timeout=BaseRequest.DEFAULT_NONE,
+                             connect_timeout=BaseRequest.DEFAULT_NONE, pool_timeout=BaseRequest.DEFAULT_NONE):
+            files = request_data.multipart_data if request_data else None
+            data = request_data.json_parameters if request_data else None
+
+            def pick(value, default):
+                return default if isinstance(value, type(BaseRequest.DEFAULT_NONE)) else value
+
+            timeout = httpx.Timeout(
+                connect=pick(connect_timeout, TELEGRAM_TIMEOUT.connect),
+                read=pick(read_timeout, TELEGRAM_TIMEOUT.read),
+                write=pick(write_timeout, TELEGRAM_MEDIA_WRITE_TIMEOUT if files else TELEGRAM_TIMEOUT.write),
+                pool=pick(pool_timeout, TELEGRAM_TIMEOUT.pool),
+            )
+            try:
+                response = await self.client.request(
+                    method=method, url=url, headers={'User-Agent': self.USER_AGENT},
+                    timeout=timeout, files=files, data=data,
+                )
+            except httpx.TimeoutException as e:
+                raise TimedOut(f"httpx.{e.__class__.__name__}: {e}") from e
+            except httpx.HTTPError as e:
+                raise NetworkError(f"httpx.{e.__class__.__name__}: {e}") from e
+            return response.status_code, response.content
+
+    request = TelegramRequest(http)
+    return Bot(token=TELEGRAM_BOT_TOKEN, request=request, get_updates_request=request)
+
+async def fetch_feed(http: httpx.AsyncClient, url, cache):
+    """Условный GET ленты.
+
+    Возвращает (тело в байтах, новые валидаторы) или (None, валидаторы), если лента не изменилась:
+    сервер ответил 304 или прислал тело с тем же хэшем. Кодировку определяет парсер по XML-декларации.
+    """
+    headers = {}
+    if cache.get('url') == url:
+        if cache.get('etag'):
+            headers['If-None-Match'] = cache['etag']
+        if cache.get('last_modified'):
+            headers['If-Modified-Since'] = cache['last_modified']
+
+    response = await http.get(url, headers=headers, timeout=FEED_TIMEOUT)
+    if response.status_code == 304:
+        return None, cache
+    response.raise_for_status()
+
+    validators = {
+        'url': url,
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'sha256': hashlib.sha256(response.content).hexdigest(),
+    }
+    if cache.get('url') == url and cache.get('sha256') == validators['sha256']:
+        return None, validators
+    return response.content, validators
+
+class LLMUnavailable(Exception):
+    """Ни один провайдер LLM не ответил."""
+
+class LLMProvider:
+    """Бэкенд LLM со своим лимитом параллельных запросов и статистикой для маршрутизации."""
+
+    kind = None
+
+    def __init__(self, name, model, concurrency):
+        self.name = name
+        self.model = model
+        # Лимит параллельных запросов; слоты раздаёт LLMRouter
+        self.concurrency = max(1, concurrency)
+        self.active = 0
+        # Последние задержки успешных ответов, по ним считается p50
+        self.latencies = deque(maxlen=50)
+        # Circuit breaker: подряд идущие ошибки и момент, до которого провайдер выключен
+        self.failures = 0
+        self.open_until = 0.0
+
+    def p50(self):
+        """Медиана задержки или None, пока успешных ответов не было."""
+        return statistics.median(self.latencies) if self.latencies else None
+
+    async def complete(self, messages, max_tokens, temperature, json_mode=False):
+        """Возвращает (текст ответа, израсходованные токены или None)."""
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+class GroqProvider(LLMProvider):
+    kind = 'groq'
+
+    def __init__(self, http, api_key, model, concurrency):
+        super().__init__('groq', model, concurrency)
+        self.http = http
+        self.api_key = api_key
+        self.client = None
+
+    async def complete(self, messages, max_tokens, temperature, json_mode=False):
+        if self.client is None:
+            from groq import AsyncGroq
+            self.client = AsyncGroq(api_key=self.api_key, http_client=self.http)
+        kwargs = {'response_format': {"type": "json_object"}} if json_mode else {}
+        completion = await self.client.chat.completions.create(
+            model=self.model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            **kwargs
+        )
+        usage = getattr(completion, 'usage', None)
+        return completion.choices[0].message.content, getattr(usage, 'total_tokens', None)
+
+class OpenAICompatibleProvider(LLMProvider):
+    """Любой сервер с POST {base_url}/chat/completions в формате OpenAI (vLLM, Ollama, локальная заглушка)."""
+
+    kind = 'openai'
+
+    def __init__(self, http, name, base_url, api_key, model, concurrency, timeout=60):
+        super().__init__(name, model, concurrency)
+        self.http = http
+        self.url = base_url.rstrip('/') + '/chat/completions'
+        self.headers = {'Authorization': f'Bearer {api_key}'} if api_key else {}
+        self.timeout = httpx.Timeout(timeout, connect=HTTP_CONNECT_TIMEOUT)
+
+    async def complete(self, messages, max_tokens, temperature, json_mode=False):
+        payload = {
+            'model': self.model,
+            'messages': messages,
+            'temperature': temperature,
+            'max_tokens': max_tokens,
+        }
+        if json_mode:
+            payload['response_format'] = {'type': 'json_object'}
+        response = await self.http.post(self.url, json=payload, headers=self.headers, timeout=self.timeout)
+        response.raise_for_status()
+        data = response.json()
+        return data['choices'][0]['message']['content'], (data.get('usage') or {}).get('total_tokens')
+
+class AmveraProvider(LLMProvider):
+    """Amvera LLM Inference API, тот же формат, что call_ai в old/app.py."""
+
+    kind = 'amvera'
+
+    def __init__(self, http, endpoint, token, model, concurrency, timeout=40):
+        super().__init__('amvera', model, concurrency)
+        self.http = http
+        self.endpoint = endpoint
+        self.headers = {'X-Auth-Token': 'Bearer ' + token, 'Content-Type': 'application/json'}
+        self.timeout = httpx.Timeout(timeout, connect=HTTP_CONNECT_TIMEOUT)
+
+    async def complete(self, messages, max_tokens, temperature, json_mode=False):
+        payload = {
+            'model': self.model,
+            'messages': [{'role': m['role'], 'text': m['content']} for m in messages],
+        }
+        response = await self.http.post(self.endpoint, json=payload, headers=self.headers, timeout=self.timeout)
+        response.raise_for_status()
+        data = response.json() or {}
+        choices = data.get('choices') or []
+        if not choices:
+            raise ValueError("Amvera вернула пустой ответ")
+        content = ((choices[0] or {}).get('message') or {}).get('content') or ''
+        return content, (data.get('usage') or {}).get('total_tokens')
+
+def _status_code(error):
+    status = getattr(error, 'status_code', None)
+    if status is None:
+        status = getattr(getattr(error, 'response', None), 'status_code', None)
+    return status
+
+class LLMRouter:
+    """Выбирает провайдера для запроса.
+
+    Исправные провайдеры ранжируются по возрастанию p50 задержки; ещё не ответившие
+    идут после измеренных, в порядке из LLM_PROVIDERS. Запрос берёт первого по рангу
+    провайдера со свободным слотом, а в очередь встаёт, только когда заняты все:
+    медленный или перегруженный провайдер не держит запросы, пока другой простаивает.
+    После LLM_FAILURE_THRESHOLD ошибок подряд или сразу после 429 провайдер выключается
+    на LLM_COOLDOWN секунд, а запрос уходит следующему.
+    """
+
+    def __init__(self, providers, failure_threshold, cooldown):
+        self.providers = providers
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        # Для ключа кэша: один и тот же набор моделей даёт взаимозаменяемые ответы
+        self.cache_id = '|'.join(f'{p.name}:{p.model}' for p in providers)
+        # Будит запросы, ждущие свободного слота у любого провайдера
+        self.released = asyncio.Event()
+
+    def ordered(self):
+        now = time.monotonic()
+        ranked = []
+        for i, p in enumerate(self.providers):
+            if p.open_until <= now:
+                p50 = p.p50()
+                ranked.append((p50 is None, p50 or 0.0, i, p))
+        return [item[-1] for item in sorted(ranked, key=lambda item: item[:3])]
+
+    async def _acquire(self, tried):
+        """Слот у лучшего по рангу провайдера не из tried; None — пробовать больше некого."""
+        while True:
+            candidates = [p for p in self.ordered() if p not in tried]
+            if not candidates:
+                return None
+            for provider in candidates:
+                if provider.active < provider.concurrency:
+                    provider.active += 1
+                    return provider
+            self.released.clear()
+            await self.released.wait()
+
+    def _release(self, provider):
+        provider.active -= 1
+        self.released.set()
+
+    def _failed(self, provider, error):
+        provider.failures += 1
+        if _status_code(error) == 429 or provider.failures >= self.failure_threshold:
+            now = time.monotonic()
+            if provider.open_until <= now:
+                logger.warning(f"LLM-провайдер {provider.name} отключён на {self.cooldown:.0f} с")
+            provider.open_until = now + self.cooldown
+
+    async def complete(self, messages, max_tokens, temperature, json_mode=False, label=''):
+        errors = []
+        tried = set()
+        while True:
+            provider = await self._acquire(tried)
+            if provider is None:
+                break
+            tried.add(provider)
+            started = time.monotonic()
+            try:
+                text, tokens = await provider.complete(messages, max_tokens, temperature, json_mode)
+            except Exception as e:
+                logger.error(f"Ошибка LLM {provider.name} для {label}: {e}")
+                metrics.inc('llm_errors', provider=provider.name)
+                self._failed(provider, e)
+                errors.append(f"{provider.name}: {e}")
+                continue
+            finally:
+                self._release(provider)
+            elapsed = time.monotonic() - started
+            provider.latencies.append(elapsed)
+            provider.failures = 0
+            metrics.observe(f'llm_request:{provider.name}', elapsed)
+            metrics.inc('llm_requests', provider=provider.name)
+            if tokens:
+                metrics.inc('llm_tokens', tokens, provider=provider.name)
+            return text
+        raise LLMUnavailable('; '.join(errors) or "все провайдеры LLM временно отключены")
+
+    async def close(self):
+        for provider in self.providers:
+            try:
+                await provider.close()
+            except Exception as e:
+                logger.error(f"Ошибка закрытия LLM-провайдера {provider.name}: {e}")
+
+def llm_hosts():
+    """Хосты включённых LLM-провайдеров, для отдельных пулов в build_http_client."""
+    urls = {'groq': 'https://api.groq.com', 'openai': OPENAI_BASE_URL, 'amvera': AMVERA_ENDPOINT}
+    kinds = [k.strip() for k in LLM_PROVIDERS.split(',') if k.strip()]
+    return [urlsplit(urls[kind]).netloc for kind in kinds if urls.get(kind)]
+
+def build_llm_router(http: httpx.AsyncClient):
+    """Собирает провайдеров из LLM_PROVIDERS (через запятую: groq, openai, amvera)."""
+    providers = []
+    for kind in [k.strip() for k in LLM_PROVIDERS.split(',') if k.strip()]:
+        if kind == 'groq':
+            if not GROQ_API_KEY:
+                raise ValueError("Для провайдера groq нужен GROQ_API_KEY")
+            providers.append(GroqProvider(http, GROQ_API_KEY, GROQ_MODEL, GROQ_CONCURRENCY))
+        elif kind == 'openai':
+            if not OPENAI_BASE_URL:
+                raise ValueError("Для провайдера openai нужен OPENAI_BASE_URL")
+            providers.append(OpenAICompatibleProvider(
+                http, 'openai', OPENAI_BASE_URL, OPENAI_API_KEY, OPENAI_MODEL, OPENAI_CONCURRENCY
+            ))
+        elif kind == 'amvera':
+            if not AMVERA_API_TOKEN:
+                raise ValueError("Для провайдера amvera нужен AMVERA_API_TOKEN")
+            providers.append(AmveraProvider(http, AMVERA_ENDPOINT, AMVERA_API_TOKEN, AMVERA_MODEL, AMVERA_CONCURRENCY))
+        else:
+            raise ValueError(f"Неизвестный LLM-провайдер: {kind}")
+    if not providers:
+        raise ValueError("LLM_PROVIDERS пуст")
+    return LLMRouter(providers, LLM_FAILURE_THRESHOLD, LLM_COOLDOWN)
+
+async def generate_title(llm: LLMRouter, guid: str, prompt: str,
+                         cache: Optional[LLMCache] = None, cache_key: Optional[str] = None):
+    """Возвращает новый заголовок или None, если ни один провайдер LLM не ответил."""
+    if cache is not None:
+        cached = cache.get(cache_key)
+        if cached is not None:
+            logger.info(f"Заголовок для {guid} взят из кэша: {cached}")
+            metrics.inc('llm_cache_hits')
+            return cached
 
-    # Загрузка RSS
-    rss_url = 'https://habr.com/ru/rss/articles/?fl=ru'
     try:
-        response = requests.get(rss_url)
+        content = await llm.complete(
+            [{"role": "user", "content": prompt}], max_tokens=128, temperature=0.95, label=guid
+        )
+    except LLMUnavailable as e:
+        logger.error(f"Не удалось получить заголовок для {guid}: {e}")
+        return None
+    new_title = (content or '').strip()
+    if not new_title:
+        logger.error(f"LLM вернул пустой заголовок для {guid}")
+        return None
+    logger.info(f"Новый заголовок для {guid}: {new_title}")
+    if cache is not None:
+        try:
+            cache.put(cache_key, new_title)
+        except Exception as e:
+            logger.error(f"Ошибка записи в кэш LLM: {e}")
+    return new_title
+
+# Заголовок длиннее этого в пакетном ответе считаем мусором и перегенерируем по одному
+MAX_TITLE_LENGTH = 250
+
+def build_batch_template(prompt_template, wrapper):
+    """Пакетный промпт: правила стиля из prompt.txt, подставленные в обёртку prompt_batch.txt.
+
+    Правила — всё, что в prompt.txt стоит до строки «Верни …» с форматом ответа для одной
+    статьи (если такой строки нет — до строки с {{TITLE}}); в обёртке они идут вместо {{RULES}}.
+    Так стиль и примеры живут в одном файле, а prompt_batch.txt описывает только формат пакета.
+    """
+    lines = prompt_template.splitlines()
+    end = next((i for i, line in enumerate(lines) if line.startswith('Верни ')), None)
+    if end is None:
+        end = next((i for i, line in enumerate(lines) if '{{TITLE}}' in line), len(lines))
+    return wrapper.replace('{{RULES}}', '\n'.join(lines[:end]).strip())
+
+def parse_batch_titles(content, ids):
+    """Разбирает ответ пакетного запроса: {"titles": {id: заголовок}} → {id: заголовок}.
+
+    Возвращает только валидные заголовки для известных id; всё остальное отбрасывается.
+    """
+    try:
+        data = json.loads(content)
+    except (TypeError, ValueError):
+        return {}
+    if isinstance(data, dict) and isinstance(data.get('titles'), dict):
+        data = data['titles']
+    if not isinstance(data, dict):
+        return {}
+
+    result = {}
+    for item_id in ids:
+        title = data.get(item_id)
+        if not isinstance(title, str):
+            continue
+        title = title.strip().strip('"«»').strip()
+        if title and '\n' not in title and len(title) <= MAX_TITLE_LENGTH:
+            result[item_id] = title
+    return result
+
+async def generate_batch(llm: LLMRouter, batch_template: str, items, include_description: bool):
+    """Один запрос на несколько статей. items — [(guid, PreparedEntry)]; возвращает {guid: заголовок}."""
+    ids = [str(i + 1) for i in range(len(items))]
+    articles = []
+    for item_id, (_, prepared) in zip(ids, items):
+        article = {'id': item_id, 'title': prepared.title}
+        if include_description:
+            article['description'] = prepared.description
+        articles.append(article)
+    prompt = batch_template.replace('{{ARTICLES}}', json.dumps(articles, ensure_ascii=False, indent=1))
+
+    try:
+        content = await llm.complete(
+            [{"role": "user", "content": prompt}],
+            max_tokens=96 * len(items) + 64,
+            temperature=0.95,
+            json_mode=True,
+            label=f"пакета из {len(items)} статей"
+        )
+    except LLMUnavailable as e:
+        logger.error(f"Пакет из {len(items)} статей не сгенерирован: {e}")
+        return {}
+
+    parsed = parse_batch_titles(content, ids)
+    if len(parsed) < len(items):
+        logger.warning(f"Пакетный ответ содержит {len(parsed)} из {len(items)} заголовков, остальные — по одному")
+    titles = {}
+    for item_id, (guid, _) in zip(ids, items):
+        if item_id in parsed:
+            titles[guid] = parsed[item_id]
+            logger.info(f"Новый заголовок для {guid}: {parsed[item_id]}")
+    return titles
+
+async def generate_titles(service, pending):
+    """Заголовки для pending — [(guid, PreparedEntry, prompt, cache_key)], в том же порядке.
+
+    Сначала кэш, затем при LLM_BATCH_SIZE > 1 пакеты по LLM_BATCH_SIZE статей, а то,
+    что пакет не вернул или вернул криво, — отдельными запросами. None — не удалось.
+    """
+    # Генерируем параллельно; сколько запросов одновременно идёт к каждому провайдеру,
+    # ограничивает сам LLMRouter
+    cache = service.llm_cache
+    titles = {}
+
+    if service.batch_template and LLM_BATCH_SIZE > 1:
+        to_batch = []
+        for guid, prepared, _, cache_key in pending:
+            cached = cache.get(cache_key)
+            if cached is not None:
+                logger.info(f"Заголовок для {guid} взят из кэша: {cached}")
+                metrics.inc('llm_cache_hits')
+                titles[guid] = cached
+            else:
+                to_batch.append((guid, prepared))
+
+        include_description = '{{DESCRIPTION}}' in service.prompt_template
+        batches = [to_batch[i:i + LLM_BATCH_SIZE] for i in range(0, len(to_batch), LLM_BATCH_SIZE)]
+        for result in await asyncio.gather(
+            *(generate_batch(service.llm, service.batch_template, batch, include_description)
+              for batch in batches)
+        ):
+            titles.update(result)
+
+        keys = {guid: cache_key for guid, _, _, cache_key in pending}
+        for guid in titles.keys() & {guid for guid, _ in to_batch}:
+            try:
+                cache.put(keys[guid], titles[guid])
+            except Exception as e:
+                logger.error(f"Ошибка записи в кэш LLM: {e}")
+
+    rest = [(guid, prompt, cache_key) for guid, _, prompt, cache_key in pending if guid not in titles]
+    single = await asyncio.gather(
+        *(generate_title(service.llm, guid, prompt, cache, cache_key) for guid, prompt, cache_key in rest)
+    )
+    titles.update((guid, title) for (guid, _, _), title in zip(rest, single))
+
+    return [titles.get(guid) for guid, _, _, _ in pending]
+
+class ImageUnusable(Exception):
+    """Картинку нельзя отправить через send_photo ни как есть, ни после пережатия."""
+
+# Форматы, которые send_photo принимает без конвертации
+TELEGRAM_PHOTO_TYPES = {'image/jpeg', 'image/png', 'image/webp'}
+
+async def download_image(http: httpx.AsyncClient, url):
+    """Скачивает картинку, проверив тип и размер по заголовкам до чтения тела.
+
+    Возвращает (байты, MIME-тип). ImageUnusable — картинка заведомо не подойдёт,
+    прочие исключения — временные сетевые ошибки.
+    """
+    async with http.stream('GET', url, timeout=IMAGE_TIMEOUT) as response:
+        if response.status_code in (403, 404, 410):
+            raise ImageUnusable(f"HTTP {response.status_code}")
         response.raise_for_status()
-        rss_content = response.text
-        feed = feedparser.parse(rss_content)
+
+        mime = response.headers.get('Content-Type', '').split(';', 1)[0].strip().lower()
+        if not mime.startswith('image/'):
+            raise ImageUnusable(f"не картинка: {mime or 'тип не указан'}")
+        length = response.headers.get('Content-Length')
+        if length and length.isdigit() and int(length) > IMAGE_MAX_DOWNLOAD:
+            raise ImageUnusable(f"слишком большая: {int(length)} байт")
+
+        chunks = []
+        size = 0
+        async for chunk in response.aiter_bytes():
+            size += len(chunk)
+            if size > IMAGE_MAX_DOWNLOAD:
+                raise ImageUnusable(f"слишком большая: больше {IMAGE_MAX_DOWNLOAD} байт")
+            chunks.append(chunk)
+    return b''.join(chunks), mime
+
+def prepare_image(data, mime):
+    """Приводит картинку к ограничениям send_photo; возвращает байты для загрузки.
+
+    Подходящая картинка возвращается без изменений. Слишком большую или в другом
+    формате Pillow уменьшает до IMAGE_MAX_SIDE и пережимает в JPEG; без Pillow
+    такие картинки считаются непригодными.
+    """
+    try:
+        from PIL import Image
+    except ImportError:  # без Pillow картинки проверяются только по заголовкам ответа
+        Image = None
+    if Image is None:
+        if mime in TELEGRAM_PHOTO_TYPES and len(data) <= IMAGE_MAX_BYTES:
+            return data
+        raise ImageUnusable(f"{mime}, {len(data)} байт, а Pillow не установлен")
+
+    # Image.open читает только заголовок: подходящую картинку не декодируем вовсе
+    try:
+        image = Image.open(io.BytesIO(data))
     except Exception as e:
-        logger.error(f"Не удалось загрузить RSS: {e}")
-        return
+        raise ImageUnusable(f"не открывается: {e}")
+
+    width, height = image.size
+    if not width or not height or max(width, height) / min(width, height) > 20:
+        raise ImageUnusable(f"недопустимые пропорции {width}x{height}")
+    fits = (
+        Image.MIME.get(image.format) in TELEGRAM_PHOTO_TYPES
+        and len(data) <= IMAGE_MAX_BYTES
+        and max(width, height) <= IMAGE_MAX_SIDE
+    )
+    if fits:
+        return data
 
-    app_path = '.'
-    if os.path.exists('/.dockerenv'):
-        app_path = '/app/data'
+    try:
+        image.draft('RGB', (IMAGE_MAX_SIDE, IMAGE_MAX_SIDE))
+        image.load()
+    except Exception as e:
+        raise ImageUnusable(f"не декодируется: {e}")
+    if image.mode not in ('RGB', 'L'):
+        # Прозрачность кладём на белый фон, JPEG её не поддерживает
+        rgba = image.convert('RGBA')
+        image = Image.new('RGB', rgba.size, (255, 255, 255))
+        image.paste(rgba, mask=rgba.split()[-1])
+    image.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE))
+    for quality in (85, 75, 60, 45):
+        out = io.BytesIO()
+        image.save(out, format='JPEG', quality=quality, optimize=True)
+        if out.tell() <= IMAGE_MAX_BYTES:
+            return out.getvalue()
+    raise ImageUnusable(f"не ужимается до {IMAGE_MAX_BYTES} байт")
 
-    # Загрузка базы обработанных статей
-    articles = {}
-    if os.path.exists(os.path.join(app_path,ARTICLES_FILE)):
+class TelegramImages:
+    """Подготовка картинок к send_photo и кэш file_id по URL картинки.
+
+    prefetch() запускает загрузку заранее, параллельно с генерацией заголовков;
+    resolve() отдаёт то, что передать в send_photo. Повторы и репосты в другие
+    каналы используют file_id и не загружают картинку снова.
+    """
+
+    def __init__(self, http, cache: ImageCache, concurrency):
+        self.http = http
+        self.cache = cache
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.tasks = {}
+
+    def prefetch(self, urls):
+        for url in urls:
+            if url and url not in self.tasks and self.cache.get(url) is None:
+                self.tasks[url] = asyncio.create_task(self._load(url))
+
+    async def _load(self, url):
         try:
-            with open(os.path.join(app_path,ARTICLES_FILE), 'r', encoding='utf-8') as f:
-                articles = json.load(f)
-            logger.info(f"Загружено {len(articles)} ранее обработанных статей.")
+            async with self.semaphore:
+                with metrics.span('image_fetch'):
+                    data, mime = await download_image(self.http, url)
+                data = await asyncio.to_thread(prepare_image, data, mime)
+            self.cache.put(url, 'ok', data=data)
+            metrics.inc('images', result='ok')
+        except ImageUnusable as e:
+            logger.warning(f"Картинка {url} не подходит для Telegram, пост уйдёт текстом: {e}")
+            self.cache.put(url, 'unusable', error=str(e))
+            metrics.inc('images', result='unusable')
         except Exception as e:
-            logger.error(f"Ошибка чтения articles.json: {e}")
+            # Временная ошибка: Telegram попробует скачать картинку сам
+            logger.warning(f"Не удалось скачать картинку {url}: {e}")
+            metrics.inc('images', result='error')
+        finally:
+            self.tasks.pop(url, None)
+
+    async def resolve(self, url):
+        """(photo, source): file_id, байты или сам URL для send_photo; (None, None) — слать текстом."""
+        row = self.cache.get(url)
+        if row is None:
+            if url not in self.tasks:
+                self.prefetch([url])
+            await asyncio.shield(self.tasks[url])
+            row = self.cache.get(url)
+        if row is None:
+            return url, 'url'
+        status, file_id, data = row
+        if status != 'ok':
+            return None, None
+        if file_id:
+            return file_id, 'file_id'
+        if data:
+            return data, 'upload'
+        return url, 'url'
+
+    def remember(self, url, message):
+        photos = getattr(message, 'photo', None)
+        if photos:
+            self.cache.set_file_id(url, photos[-1].file_id)
+
+    def reject(self, url, source, error):
+        """Telegram не принял картинку. Устаревший file_id забываем, чтобы загрузить заново."""
+        if source == 'file_id':
+            self.cache.forget(url)
+        else:
+            self.cache.put(url, 'unusable', error=str(error))
+
+    async def close(self):
+        for task in list(self.tasks.values()):
+            task.cancel()
+        await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+
+def build_telegram_post(new_title: str, prepared: PreparedEntry, article_url: str):
+    """Готовит пост для очереди отправки: {'photo': url или None, 'text': HTML}."""
+    img_url = prepared.image_url
+
+    # Кликабельный заголовок
+    linked_title = f'<b><a href="{article_url}">{new_title}</a></b>'
+
+    # Описание уже очищено и разбито на абзацы в preprocess_entry
+    paragraphs = prepared.paragraphs
+
+    # Начинаем формировать подпись: заголовок + абзацы по одному, пока влезаем
+    caption_parts = [linked_title]
+    current_length = len(linked_title) + 2  # +2 за переносы
+
+    max_caption_length = 950  # безопасный лимит
+
+    for para in paragraphs:
+        # Добавляем абзац с двумя переносами
+        test_length = current_length + len(para) + 2
+        if test_length > max_caption_length:
+            break
+        caption_parts.append(para)
+        current_length = test_length
+
+    # Если обрезали — добавляем "Читать дальше" как ссылку
+    if len(caption_parts) < len(paragraphs) + 1:  # +1 потому что заголовок уже есть
+        caption_parts.append(f'\n\n<tg-spoiler>… <a href="{article_url}">Читать дальше на Habr</a></tg-spoiler>')
+
+    caption = '\n\n'.join(caption_parts)
+
+    # Если нет фото — можно чуть больше текста, но всё равно обрезаем красиво
+    if not img_url and len(caption) > 4000:
+        caption = caption[:4000] + f'\n\n<tg-spoiler>… <a href="{article_url}">Читать дальше</a></tg-spoiler>'
+
+    return {'photo': img_url, 'text': caption}
+
+async def send_to_telegram(bot: 'Bot', channel_id: str, post: dict):
+    """Отправляет готовый пост и возвращает сообщение. Ошибки пробрасываются — их разбирает TelegramDelivery.
+
+    post['photo'] — URL, file_id или байты картинки; без неё уходит текстовый пост.
+    """
+    from telegram.constants import ParseMode
+
+    # Отправляем фото с подписью (или просто текст, если нет фото)
+    if post.get('photo'):
+        return await bot.send_photo(
+            chat_id=channel_id,
+            photo=post['photo'],
+            caption=post['text'],
+            parse_mode=ParseMode.HTML
+        )
+    else:
+        return await bot.send_message(
+            chat_id=channel_id,
+            text=post['text'],
+            parse_mode=ParseMode.HTML,
+            disable_web_page_preview=True
+        )
+
+class TokenBucket:
+    """Классический token bucket: rate токенов в секунду, не больше capacity про запас."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        """Сколько ждать до следующего токена (0 — можно отправлять)."""
+        now = time.monotonic()
+        self._refill(now)
+        wait = max(0.0, self.blocked_until - now)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    def take(self):
+        self._refill(time.monotonic())
+        self.tokens -= 1
+
+    def block(self, seconds):
+        """Telegram попросил подождать (RetryAfter): не тратим токены до истечения паузы."""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = min(self.tokens, 0)
+
+class TelegramRateLimiter:
+    """Общий лимит бота и отдельный лимит на каждый чат/канал."""
+
+    def __init__(self, global_rate, per_chat_rate_per_minute):
+        self.global_bucket = TokenBucket(global_rate, max(1.0, global_rate))
+        self.per_chat_rate = per_chat_rate_per_minute / 60
+        self.chats = {}
+
+    def _chat(self, chat_id):
+        bucket = self.chats.get(chat_id)
+        if bucket is None:
+            # Небольшой запас, чтобы короткая пачка ушла сразу, а дальше — ровным темпом
+            bucket = self.chats[chat_id] = TokenBucket(self.per_chat_rate, 3)
+        return bucket
+
+    def chat_delay(self, chat_id):
+        """Сколько чату ждать своего лимита или RetryAfter; общий лимит бота не учитывается."""
+        return self._chat(chat_id).delay()
+
+    async def acquire(self, chat_id):
+        chat = self._chat(chat_id)
+        while True:
+            wait = max(self.global_bucket.delay(), chat.delay())
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait)
+        self.global_bucket.take()
+        chat.take()
+
+    def block(self, chat_id, seconds):
+        self._chat(chat_id).block(seconds)
+
+def _is_photo_error(error):
+    """BadRequest из-за картинки, а не из-за текста поста."""
+    text = str(error).lower()
+    return any(marker in text for marker in ('photo', 'image', 'file', 'url content', 'web page content'))
+
+class TelegramDelivery:
+    """Доставка постов из очереди outbox в ArticleStore.
+
+    Пост помечается отправленным только после ответа Telegram, поэтому после
+    падения или перезапуска неотправленное уходит снова (at-least-once).
+    Генерация только кладёт посты в очередь и будит доставку через notify().
+    Bot создаётся через connect() перед первой отправкой, пустая очередь его не требует.
+    """
+
+    def __init__(self, connect, store, limiter, images: Optional[TelegramImages] = None):
+        self.connect = connect
+        self.bot = None
+        self.store = store
+        self.limiter = limiter
+        self.images = images
+        self.wakeup = asyncio.Event()
+        self.closing = False
+
+    def notify(self):
+        self.wakeup.set()
+
+    def close(self):
+        """Дослать то, что можно отправить в ближайшие TELEGRAM_DRAIN_WAIT секунд, и остановиться."""
+        self.closing = True
+        self.wakeup.set()
+
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            # Через сколько освободится чат, посты которого пришлось придержать
+            ready_in = None
+            try:
+                now = time.time()
+                due = self.store.outbox_due(now)
+                held = set()
+                delivered = False
+                for post_id, chat_id, payload, attempts in due:
+                    if chat_id in held:
+                        continue
+                    # Чат, упёршийся в свой лимит или RetryAfter, не задерживает остальные
+                    wait = self.limiter.chat_delay(chat_id)
+                    if wait > 0:
+                        held.add(chat_id)
+                        ready_in = wait if ready_in is None else min(ready_in, wait)
+                        continue
+                    delivered = True
+                    if not await self._deliver(post_id, chat_id, payload, attempts):
+                        # Пост остался в очереди: следующие посты чата не должны его обогнать
+                        held.add(chat_id)
+            except Exception as e:
+                logger.exception(f"Ошибка очереди Telegram: {e}")
+                await asyncio.sleep(5)
+                continue
+            if delivered:
+                continue
+
+            # Придержанные посты уже «пора» отправлять, поэтому ближайшую попытку ищем после now
+            next_at = self.store.outbox_next_attempt(after=now)
+            now = time.time()
+            if ready_in is not None:
+                next_at = now + ready_in if next_at is None else min(next_at, now + ready_in)
+            if self.closing:
+                if next_at is None or next_at - now > TELEGRAM_DRAIN_WAIT:
+                    pending = self.store.outbox_pending()
+                    if pending:
+                        logger.info(f"В очереди Telegram осталось {pending} постов, они уйдут позже.")
+                    return
+            timeout = 60.0 if next_at is None else min(60.0, max(0.0, next_at - now))
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _deliver(self, post_id, chat_id, payload, attempts):
+        """Одна попытка отправки; True — пост ушёл из очереди (отправлен или отклонён насовсем)."""
+        from telegram.error import BadRequest, Forbidden, RetryAfter
+
+        if self.bot is None:
+            self.bot = self.connect()
+        post = json.loads(payload)
+        image_url, source = post.get('photo'), None
+        if image_url and self.images is not None:
+            post['photo'], source = await self.images.resolve(image_url)
+
+        with metrics.span('telegram_wait'):
+            await self.limiter.acquire(chat_id)
+        try:
+            with metrics.span('telegram_send'):
+                message = await send_to_telegram(self.bot, chat_id, post)
+        except BadRequest as e:
+            if not post.get('photo') or source is None or not _is_photo_error(e):
+                logger.error(f"Telegram отклонил пост {post_id} для {chat_id}: {e}")
+                metrics.inc('telegram_failed')
+                self.store.outbox_fail(post_id, str(e))
+                return True
+            # Пост не теряем из-за картинки: устаревший file_id загрузим заново,
+            # а непринятую картинку заменим текстовым постом
+            logger.warning(f"Telegram не принял картинку {image_url} ({source}): {e}")
+            metrics.inc('telegram_retries', reason='photo')
+            self.images.reject(image_url, source, e)
+            self.store.outbox_retry(post_id, 0, str(e), count_attempt=False)
+            return False
+        except RetryAfter as e:
+            metrics.inc('telegram_retries', reason='flood')
+            retry_after = e.retry_after
+            if isinstance(retry_after, timedelta):
+                retry_after = retry_after.total_seconds()
+            logger.warning(f"Telegram просит подождать {retry_after} с перед отправкой в {chat_id}")
+            self.limiter.block(chat_id, retry_after)
+            # Флуд-контроль — не ошибка поста, попытку не засчитываем
+            self.store.outbox_retry(post_id, retry_after, str(e), count_attempt=False)
+            return False
+        except Forbidden as e:
+            logger.error(f"Telegram отклонил пост {post_id} для {chat_id}: {e}")
+            metrics.inc('telegram_failed')
+            self.store.outbox_fail(post_id, str(e))
+            return True
+        except Exception as e:
+            attempts += 1
+            if attempts >= TELEGRAM_MAX_ATTEMPTS:
+                logger.error(f"Пост {post_id} не отправлен за {attempts} попыток: {e}")
+                metrics.inc('telegram_failed')
+                self.store.outbox_fail(post_id, str(e))
+            else:
+                metrics.inc('telegram_retries', reason='error')
+                delay = min(3600, 5 * 2 ** attempts)
+                logger.warning(f"Ошибка отправки в Telegram (попытка {attempts}), повтор через {delay} с: {e}")
+                self.store.outbox_retry(post_id, delay, str(e))
+                return False
+            return True
+
+        self.store.outbox_sent(post_id)
+        metrics.inc('telegram_sent')
+        if source is not None and source != 'file_id':
+            self.images.remember(image_url, message)
+        logger.info("Успешно отправлено в Telegram (компактная версия)")
+        return True
 
-    # Подготовка клиентов
-    groq_client = Groq(api_key=GROQ_API_KEY)
-    bot = Bot(token=TELEGRAM_BOT_TOKEN)
+CHANNEL_TITLE = "Честная ИИ-лента Хабра"
+
+def _localname(tag):
+    return tag.rsplit('}', 1)[-1] if isinstance(tag, str) else None
+
+def _serialize(elem, declared=()):
+    """Элемент в байтах без повторного объявления пространств имён, уже объявленных в <rss>."""
+    data = etree.tostring(elem, encoding='utf-8')
+    head, sep, rest = data.partition(b'>')
+    for decl in declared:
+        head = head.replace(decl, b'', 1)
+    return head + sep + rest
+
+def _open_close_tags(elem, declared=(), extra_nsmap=None):
+    """Открывающий и закрывающий теги элемента без содержимого (для <rss> и <channel>)."""
+    nsmap = {**(extra_nsmap or {}), **elem.nsmap}
+    empty = _serialize(etree.Element(elem.tag, dict(elem.attrib), nsmap=nsmap), declared)
+    start = empty[:-2] + b'>'
+    name = start[1:-1].split(b' ', 1)[0]
+    return start, b'</' + name + b'>'
+
+def _iter_rss(source):
+    """Потоково разбирает RSS-документ в байтах.
+
+    Выдаёт (вид, элемент): 'root' и 'channel' — на открывающем теге, без содержимого;
+    'meta' и 'item' — прямые потомки <channel>, уже целиком. После выдачи потомок
+    отсоединяется от дерева: если на него не осталось ссылок, память освобождается сразу.
+    """
+    depth = 0
+    for event, elem in etree.iterparse(
+        io.BytesIO(source), events=('start', 'end'), remove_blank_text=True, resolve_entities=False
+    ):
+        if event == 'start':
+            depth += 1
+            if depth == 1:
+                yield 'root', elem
+            elif depth == 2 and _localname(elem.tag) == 'channel':
+                yield 'channel', elem
+            continue
+
+        depth -= 1
+        if depth != 2:
+            continue
+        parent = elem.getparent()
+        if _localname(parent.tag) == 'channel':
+            yield ('item' if _localname(elem.tag) == 'item' else 'meta'), elem
+        parent.remove(elem)
+
+def _minimal_element(tag, fields):
+    """Элемент с дочерними (тег, текст); пустые поля пропускаются."""
+    elem = etree.Element(tag)
+    for name, text in fields:
+        if text:
+            etree.SubElement(elem, name).text = text
+    return elem
+
+class FeedEntry:
+    """Статья ленты: только поля, которые нужны пайплайну, и исходный <item> для переписывания."""
+
+    __slots__ = ('guid', 'title', 'description', 'link', 'pub_date', 'categories', 'creator', 'element')
+
+    FIELDS = {'guid': 'guid', 'title': 'title', 'description': 'description',
+              'link': 'link', 'pubDate': 'pub_date', 'creator': 'creator'}
+
+    def __init__(self, guid='', title='', description='', link=None, pub_date=None,
+                 categories=(), creator=None, element=None):
+        self.guid = guid
+        self.title = title
+        self.description = description
+        self.link = link
+        self.pub_date = pub_date
+        self.categories = categories
+        self.creator = creator
+        self.element = element
+
+    @classmethod
+    def from_item(cls, item):
+        entry = cls(element=item)
+        categories = []
+        seen = set()
+        for child in item:
+            name = _localname(child.tag)
+            if name == 'category':
+                categories.append(child.text or '')
+            elif name in cls.FIELDS and name not in seen:
+                # Как у feedparser: из повторяющихся полей берётся первое
+                seen.add(name)
+                setattr(entry, cls.FIELDS[name], child.text or '')
+        entry.guid = entry.guid.strip()
+        entry.categories = categories
+        return entry
+
+    @classmethod
+    def from_feedparser(cls, entry):
+        """Статья из feedparser с минимальным <item>, чтобы её можно было переписать."""
+        # pubDate — в RFC 822, даже если лента Atom и feedparser отдал дату в ISO 8601
+        published = entry.get('published_parsed') or entry.get('updated_parsed')
+        entry = cls(
+            guid=(entry.get('guid') or entry.get('link') or '').strip(),
+            title=entry.get('title', ''),
+            description=entry.get('description', ''),
+            link=entry.get('link'),
+            pub_date=formatdate(calendar.timegm(published), usegmt=True) if published else entry.get('published'),
+            categories=[tag.get('term') or '' for tag in entry.get('tags', [])],
+            creator=entry.get('author'),
+        )
+        entry.element = _minimal_element('item', [
+            ('title', entry.title), ('link', entry.link), ('description', entry.description),
+            ('guid', entry.guid), ('pubDate', entry.pub_date),
+        ] + [('category', category) for category in entry.categories])
+        return entry
+
+class ParsedFeed:
+    """Страница RSS-ленты после единственного разбора.
+
+    root и channel — пустые копии тегов <rss> и <channel>, meta — элементы шапки канала,
+    entries — статьи с их <item>. Выходная лента собирается из этих элементов без
+    повторного разбора. Для ленты, прочитанной feedparser'ом, эти элементы собираются
+    из его полей (from_feedparser): выходная лента получается проще исходной, но пишется.
+    """
+
+    __slots__ = ('root', 'channel', 'meta', 'entries')
+
+    def __init__(self, root, channel, meta, entries):
+        self.root = root
+        self.channel = channel
+        self.meta = meta
+        self.entries = entries
+
+    @classmethod
+    def from_feedparser(cls, parsed):
+        info = parsed.get('feed', {})
+        meta = _minimal_element('channel', [
+            # title и description в RSS обязательны, а в выходной ленте всё равно заменяются на CHANNEL_TITLE
+            ('title', CHANNEL_TITLE), ('link', info.get('link')),
+            ('description', CHANNEL_TITLE), ('language', info.get('language')),
+        ])
+        return cls(
+            etree.Element('rss', version='2.0'), etree.Element('channel'), list(meta),
+            [FeedEntry.from_feedparser(entry) for entry in parsed.entries],
+        )
+
+    @classmethod
+    def parse(cls, source):
+        root = channel = None
+        meta, entries = [], []
+        for kind, elem in _iter_rss(source):
+            if kind in ('root', 'channel'):
+                copy = etree.Element(elem.tag, dict(elem.attrib), nsmap=elem.nsmap)
+                if kind == 'root':
+                    root = copy
+                else:
+                    channel = copy
+            elif kind == 'meta':
+                meta.append(elem)
+            else:
+                entries.append(FeedEntry.from_item(elem))
+        if root is None or _localname(root.tag) != 'rss' or channel is None:
+            raise ValueError("это не RSS: нет <rss> и <channel>")
+        return cls(root, channel, meta, entries)
+
+    def events(self):
+        """Те же события, что у _iter_rss, но из сохранённых элементов."""
+        yield 'root', self.root
+        yield 'channel', self.channel
+        for elem in self.meta:
+            yield 'meta', elem
+        for entry in self.entries:
+            yield 'item', entry.element
+
+def _with_text(elem, text, declared):
+    """Сериализует элемент с подменённым текстом, не меняя сохранённый элемент."""
+    original = elem.text
+    elem.text = text
+    try:
+        return _serialize(elem, declared)
+    finally:
+        elem.text = original
+
+def _rss_chunks(sources, titles, extra_nsmap=None):
+    """Выдаёт ленту по частям с уже подменёнными заголовками.
+
+    sources — страницы ленты: ParsedFeed (уже разобранные при загрузке) или XML в байтах,
+    который разбирается потоково. Выдаёт (вид, guid, данные):
+      'root', None, (открывающий, закрывающий) — тег <rss>, к нему добавляются extra_nsmap;
+      'channel', None, (открывающий, закрывающий) — тег <channel>;
+      'meta', None, байты — элемент шапки канала (только с первой страницы);
+      'item', guid, байты — статья; guid — None, если её заголовок не переписан.
+    Для страниц в байтах каждый элемент освобождается сразу после выдачи, поэтому
+    память не растёт с размером ленты.
+    """
+    declared = []
+    for page, source in enumerate(sources):
+        events = source.events() if isinstance(source, ParsedFeed) else _iter_rss(source)
+        for kind, elem in events:
+            # <rss> и <channel> открываем один раз, по первой странице
+            if kind == 'root':
+                if page == 0:
+                    yield 'root', None, _open_close_tags(elem, extra_nsmap=extra_nsmap)
+                    nsmap = {**(extra_nsmap or {}), **elem.nsmap}
+                    declared = [
+                        (f' xmlns:{prefix}="{uri}"' if prefix else f' xmlns="{uri}"').encode('utf-8')
+                        for prefix, uri in nsmap.items()
+                    ]
+                continue
+            if kind == 'channel':
+                if page == 0:
+                    yield 'channel', None, _open_close_tags(elem, declared)
+                continue
+
+            name = _localname(elem.tag)
+            # Шапку канала берём с первой страницы, managingEditor выкидываем
+            if kind == 'meta' and (page > 0 or name == 'managingEditor'):
+                continue
+            elem.tail = None
+            etree.indent(elem, space='  ', level=2)
+            if kind == 'meta':
+                text = CHANNEL_TITLE if name in ('title', 'description') else elem.text
+                yield 'meta', None, _with_text(elem, text, declared)
+                continue
+
+            guid = elem.find('{*}guid')
+            guid = guid.text.strip() if guid is not None and guid.text else None
+            title = elem.find('{*}title')
+            if guid in titles and title is not None:
+                # Заголовок подменяем только на время сериализации: ParsedFeed можно переписать ещё раз
+                original = title.text
+                title.text = titles[guid]
+                try:
+                    data = _serialize(elem, declared)
+                finally:
+                    title.text = original
+                yield 'item', guid, data
+            else:
+                yield 'item', None, _serialize(elem, declared)
+
+def _write_atomic(output_path, write):
+    """Пишет файл через временный и атомарно подменяет старый."""
+    tmp_path = output_path + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as out:
+            write(out)
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def write_rss(output_path, sources, titles):
+    """Потоково переписывает RSS: заголовки статей из titles (guid → заголовок) и метаданные канала.
+
+    sources — одна или несколько страниц ленты: ParsedFeed или XML в байтах; шапка канала
+    берётся из первой, статьи — из всех по порядку. Страница в байтах разбирается потоково:
+    каждый <item> пишется сразу после разбора и освобождается. Файл пишется один раз
+    во временный и атомарно подменяет старый.
+    """
+    def write(out):
+        closing = []
+        out.write(b"<?xml version='1.0' encoding='utf-8'?>\n")
+        for kind, _, data in _rss_chunks(sources, titles):
+            if kind == 'root':
+                out.write(data[0])
+                closing.append(b'\n' + data[1])
+            elif kind == 'channel':
+                out.write(b'\n  ' + data[0])
+                closing.append(b'\n  ' + data[1])
+            else:
+                out.write(b'\n    ' + data)
+        # </channel>, затем </rss>
+        for end in reversed(closing):
+            out.write(end)
+        out.write(b'\n')
+
+    _write_atomic(output_path, write)
+
+ATOM_NS = 'http://www.w3.org/2005/Atom'
+FEED_HISTORY_NS = 'http://purl.org/syndication/history/1.0'
+
+def archive_page_path(output_path, number):
+    stem, ext = os.path.splitext(output_path)
+    return f'{stem}-archive-{number}{ext}'
+
+def _archive_link(rel, path):
+    href = html.escape(ARCHIVE_BASE_URL + os.path.basename(path), quote=True)
+    return f'<atom:link rel="{rel}" href="{href}"/>'.encode('utf-8')
+
+def _write_feed_document(path, root, channel, meta, items):
+    def write(out):
+        out.write(b"<?xml version='1.0' encoding='utf-8'?>\n" + root[0] + b'\n  ' + channel[0])
+        for data in meta:
+            out.write(b'\n    ' + data)
+        for data in items:
+            out.write(b'\n    ' + data)
+        out.write(b'\n  ' + channel[1] + b'\n' + root[1] + b'\n')
+
+    _write_atomic(path, write)
+
+def write_archive(output_path, archive: FeedArchive, sources, titles):
+    """Лента с архивом по RFC 5005 вместо зеркала текущего окна исходной ленты.
+
+    Переписанные статьи добавляются в FeedArchive. output_path содержит последние
+    ARCHIVE_ITEMS из них (и все, что ещё не попали в страницы архива) со ссылкой
+    prev-archive; каждые ARCHIVE_PAGE_SIZE статей складываются в страницу
+    <output>-archive-N: она пишется один раз, когда заполнится, и больше не меняется.
+    Сами статьи хранятся готовыми байтами, так что запись — только склейка.
+    Возвращает число новых статей в архиве; None — архив пуст и файлы не тронуты, чтобы
+    не заменить прежний output_path (например, зеркало до включения архива) пустым каналом.
+    """
+    key = os.path.basename(output_path)
+    root = channel = None
+    meta, fresh = [], []
+    for kind, guid, data in _rss_chunks(sources, titles, {'atom': ATOM_NS, 'fh': FEED_HISTORY_NS}):
+        if kind == 'root':
+            root = data
+        elif kind == 'channel':
+            channel = data
+        elif kind == 'meta':
+            meta.append(data)
+        elif guid is not None:
+            fresh.append((guid, data))
+    if root is None or channel is None:
+        raise ValueError("в ленте нет <rss> и <channel>")
+
+    published = {
+        entry.guid: moment.timestamp()
+        for source in sources if isinstance(source, ParsedFeed)
+        for entry in source.entries if (moment := published_at(entry))
+    }
+    added = archive.add(key, fresh, published)
+    total = archive.count(key)
+    if not total:
+        return None
+    pages = total // ARCHIVE_PAGE_SIZE
+
+    # Заполненные страницы неизменны: дописываем только новые, от последней до уже существующей
+    for number in range(pages, 0, -1):
+        path = archive_page_path(output_path, number)
+        if os.path.exists(path):
+            break
+        links = [b'<fh:archive/>', _archive_link('current', output_path)]
+        if number > 1:
+            links.append(_archive_link('prev-archive', archive_page_path(output_path, number - 1)))
+        _write_feed_document(path, root, channel, meta + links, archive.page(key, number, ARCHIVE_PAGE_SIZE))
+
+    links = [_archive_link('prev-archive', archive_page_path(output_path, pages))] if pages else []
+    window = max(ARCHIVE_ITEMS, total - pages * ARCHIVE_PAGE_SIZE)
+    _write_feed_document(output_path, root, channel, meta + links, archive.latest(key, window))
+    return added
+
+class Service:
+    """Ресурсы, которые живут весь процесс: база, HTTP-клиент, LLM и Telegram, промпт.
+
+    В режиме --daemon они создаются один раз и переиспользуются между опросами ленты.
+    Тяжёлые клиенты (Groq SDK, Bot) создаются при первом запросе, а не здесь.
+    """
+
+    def __init__(self, app_path, feeds, store, http, llm, prompt_template, batch_template=None):
+        self.app_path = app_path
+        self.feeds = feeds
+        self.store = store
+        self.http = http
+        self.llm = llm
+        self.prompt_template = prompt_template
+        self.batch_template = batch_template
+        # Ключ кэша LLM зависит от обоих промптов: заголовки из пакетов, сделанные по старой
+        # обёртке prompt_batch.txt, не должны переживать её правку
+        prompts = prompt_template if batch_template is None else f'{prompt_template}\0{batch_template}'
+        self.prompt_hash = hashlib.sha256(prompts.encode('utf-8')).hexdigest()
+        self.llm_cache = LLMCache(store.conn, LLM_CACHE_MAX_ENTRIES)
+        self.feed_cache_path = os.path.join(app_path, FEED_CACHE_FILE)
+        self.images = TelegramImages(http, ImageCache(store.conn), IMAGE_CONCURRENCY)
+        self.archive = FeedArchive(store.conn)
+        self.similar = SimilarityIndex(store.conn, DEDUP_MAX_DISTANCE) if DEDUP_MAX_DISTANCE >= 0 else None
+        self.delivery = TelegramDelivery(
+            lambda: build_bot(http), store, TelegramRateLimiter(TELEGRAM_RATE_GLOBAL, TELEGRAM_RATE_PER_CHAT), self.images
+        )
+
+    async def close(self):
+        await self.images.close()
+        self.store.close()
+        await self.llm.close()
+        if self.delivery.bot is not None:
+            await self.delivery.bot.shutdown()
+        await self.http.aclose()
+
+def data_path():
+    app_path = os.getenv('DATA_DIR', '')
+    if not app_path:
+        app_path = '/app/data' if os.path.exists('/.dockerenv') else '.'
+    return app_path
+
+@contextmanager
+def run_lock(path):
+    """Неблокирующий flock на файл: отдаёт True, если блокировка взята, False — её держит другой процесс.
+
+    Блокировка снимается при закрытии файла, в том числе если процесс убит.
+    """
+    fd = os.open(path, os.O_CREAT | os.O_RDWR, 0o644)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            yield False
+            return
+        # PID держателя — для того, кто будет разбираться, почему запуск пропущен
+        os.ftruncate(fd, 0)
+        os.write(fd, str(os.getpid()).encode('utf-8'))
+        yield True
+    finally:
+        os.close(fd)
+
+def open_service():
+    app_path = data_path()
 
     # Загрузка промпта
     try:
@@ -151,152 +2313,684 @@ async def main_async():
             prompt_template = f.read()
     except Exception as e:
         logger.error(f"Не удалось загрузить prompt.txt: {e}")
+        return None
+
+    # Промпт для пакетной генерации нужен, только если она включена
+    batch_template = None
+    if LLM_BATCH_SIZE > 1:
+        try:
+            with open(os.path.join(app_path,'prompt_batch.txt'), 'r', encoding='utf-8') as f:
+                batch_template = build_batch_template(prompt_template, f.read())
+        except Exception as e:
+            logger.warning(f"Не удалось загрузить prompt_batch.txt, заголовки пойдут по одному: {e}")
+
+    # Реестр лент
+    try:
+        feeds = load_feeds(app_path)
+    except Exception as e:
+        logger.error(f"Не удалось загрузить {FEEDS_FILE}: {e}")
+        return None
+
+    # База обработанных статей
+    try:
+        store = open_article_store(app_path)
+    except Exception as e:
+        logger.error(f"Не удалось открыть {ARTICLES_DB}: {e}")
+        return None
+
+    # Подготовка клиентов: вся сеть идёт через один HTTP-клиент с пулами по хостам
+    hosts = [urlsplit(feed.url).netloc for feed in feeds] + llm_hosts() + ['api.telegram.org']
+    http = build_http_client(hosts)
+    try:
+        llm = build_llm_router(http)
+    except Exception as e:
+        logger.error(f"Не удалось настроить LLM-провайдеров: {e}")
+        store.close()
+        return None
+
+    return Service(app_path, feeds, store, http, llm, prompt_template, batch_template)
+
+async def fetch_one(http: httpx.AsyncClient, feed: FeedConfig, feed_cache):
+    """Загружает одну ленту: (feed, тело, валидаторы); None — лента не изменилась или недоступна."""
+    # Условный запрос, чтобы не разбирать неизменившуюся ленту
+    try:
+        with metrics.span('fetch'):
+            rss_content, validators = await fetch_feed(http, feed.url, feed_cache.get(feed.url, {}))
+    except Exception as e:
+        logger.error(f"Не удалось загрузить RSS {feed.name}: {e}")
+        metrics.inc('feed_errors', feed=feed.name)
+        return None
+
+    if rss_content is None:
+        logger.info(f"Лента {feed.name} не изменилась с прошлого запуска.")
+        metrics.inc('feeds_unchanged', feed=feed.name)
+        return None
+
+    return feed, rss_content, validators
+
+def parse_feed(feed: FeedConfig, rss_content):
+    """Разбирает ленту одним проходом lxml; feedparser — запасной вариант для битых и не-RSS лент."""
+    try:
+        with metrics.span('parse'):
+            return ParsedFeed.parse(rss_content)
+    except (etree.XMLSyntaxError, ValueError) as e:
+        logger.warning(f"RSS {feed.name} не разбирается lxml, пробуем feedparser: {e}")
+
+    import feedparser
+
+    try:
+        with metrics.span('parse'):
+            parsed = feedparser.parse(rss_content)
+    except Exception as e:
+        logger.error(f"Не удалось разобрать RSS {feed.name}: {e}")
+        return None
+    return ParsedFeed.from_feedparser(parsed)
+
+async def run_once(service: Service):
+    """Один проход: загрузить все ленты, обработать новые статьи, обновить RSS.
+
+    Новые статьи генерируются, пока не истёк RUN_BUDGET, остальные ждут следующего прохода.
+    """
+    metrics.inc('runs')
+    deadline = time.monotonic() + RUN_BUDGET if RUN_BUDGET > 0 else None
+    with metrics.span('run'):
+        await _run_once(service, deadline)
+
+async def _run_once(service: Service, deadline=None):
+    feed_cache = load_feed_cache(service.feed_cache_path)
+    fetched = await asyncio.gather(*(fetch_one(service.http, feed, feed_cache) for feed in service.feeds))
+    fetched = [item for item in fetched if item is not None]
+
+    if not fetched:
+        logger.info("Ни одна лента не изменилась, работы нет.")
         return
 
-    new_articles = {}
+    parsed = [(feed, validators, parse_feed(feed, rss_content)) for feed, rss_content, validators in fetched]
+    parsed = [item for item in parsed if item[2] is not None]
+    if not parsed:
+        return
 
-    for entry in feed.entries:
-        guid = entry.get('guid')
-        if not guid or guid in articles:
-            continue
+    # Чаще всего лента изменилась без новых статей: тогда достаточно переписать
+    # выходные RSS, без LLM и Telegram
+    known = nothing_new(service.store, parsed)
+    if known is not None:
+        logger.info("Новых статей нет, обновляем только выходные ленты.")
+        metrics.inc('articles_seen', len(known))
+        write_outputs(service, parsed, known, set(), feed_cache)
+        return
 
-        old_title = entry.get('title', '')
-        description = entry.get('description', '')
+    await process_feeds(service, parsed, feed_cache, deadline)
+    metrics.set('outbox_pending', service.store.outbox_pending())
 
-        clean_title = clean_text(old_title)
-        clean_desc = clean_text(description)
+def nothing_new(store: ArticleStore, parsed):
+    """Заголовки статей из parsed, если все они уже обработаны и разосланы по каналам, иначе None."""
+    all_guids = [entry.guid for _, _, page in parsed for entry in page.entries if entry.guid]
+    known = store.titles(all_guids)
+    if len(known) < len(set(all_guids)):
+        return None
+    for feed, _, page in parsed:
+        guids = {entry.guid for entry in page.entries if entry.guid}
+        if feed.channel_id and len(store.posted(guids, feed.channel_id)) < len(guids):
+            return None
+    return known
 
-        prompt = prompt_template.replace('{{TITLE}}', clean_title).replace('{{DESCRIPTION}}', clean_desc)
+async def run_daemon(service: Service):
+    """Опрашивает ленту каждые POLL_INTERVAL ± POLL_JITTER секунд до SIGTERM/SIGINT.
 
+    Первый сигнал даёт закончить текущий проход, второй прерывает его.
+    """
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    current = None
+
+    def on_signal():
+        if stop.is_set() and current is not None:
+            logger.info("Повторный сигнал, прерываем текущий проход.")
+            current.cancel()
+            return
+        logger.info("Получен сигнал остановки, завершаем после текущего прохода.")
+        stop.set()
+
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, on_signal)
+
+    try:
+        while not stop.is_set():
+            current = asyncio.create_task(run_once(service))
+            try:
+                await current
+            except asyncio.CancelledError:
+                if not stop.is_set():
+                    raise
+            except Exception as e:
+                logger.exception(f"Проход завершился ошибкой: {e}")
+            current = None
+
+            delay = max(1.0, POLL_INTERVAL + random.uniform(-POLL_JITTER, POLL_JITTER))
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.remove_signal_handler(sig)
+
+async def main_async(daemon=False, backfill=None):
+    """backfill — параметры подкоманды backfill: вместо прохода по ленте догрузить старые статьи.
+
+    Пока работает один процесс с этой папкой данных (--once, --daemon или backfill),
+    другой не стартует: оба разослали бы одну и ту же очередь Telegram.
+    """
+    logger.info("Запуск сервиса...")
+
+    if not TELEGRAM_BOT_TOKEN:
+        logger.error("Отсутствуют обязательные переменные окружения.")
+        return
+
+    lock_path = os.path.join(data_path(), LOCK_FILE)
+    with run_lock(lock_path) as locked:
+        if not locked:
+            logger.warning(f"Предыдущий запуск ещё работает ({lock_path} занят), выходим.")
+            return
+        await _main_async(daemon, backfill)
+
+async def _main_async(daemon, backfill):
+    started = time.monotonic()
+    service = open_service()
+    if service is None:
+        return
+
+    metrics_server = None
+    if daemon and METRICS_PORT:
         try:
-            completion = groq_client.chat.completions.create(
-                model="meta-llama/llama-4-maverick-17b-128e-instruct",
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.95,
-                max_tokens=128
-            )
-            new_title = completion.choices[0].message.content.strip()
-            logger.info(f"Новый заголовок для {guid}: {new_title}")
+            metrics_server = await serve_metrics(METRICS_HOST, METRICS_PORT)
+        except Exception as e:
+            logger.error(f"Не удалось поднять /metrics на {METRICS_HOST}:{METRICS_PORT}: {e}")
+
+    # Доставка в Telegram работает параллельно с генерацией и заодно досылает
+    # то, что осталось в очереди с прошлых запусков
+    delivery_task = asyncio.create_task(service.delivery.run())
+    try:
+        if backfill is not None:
+            await run_backfill(service, backfill)
+        elif daemon:
+            await run_daemon(service)
+        else:
+            await run_once(service)
+    finally:
+        service.delivery.close()
+        # Неотправленное останется в очереди до следующего старта
+        if daemon:
+            timeout = 30
+        elif backfill is None and RUN_BUDGET > 0:
+            # Досылка после прохода тоже укладывается в бюджет, но получает хотя бы полминуты
+            timeout = max(30, started + RUN_BUDGET - time.monotonic())
+        else:
+            timeout = None
+        try:
+            await asyncio.wait_for(delivery_task, timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
         except Exception as e:
-            logger.error(f"Ошибка Groq API для {guid}: {e}")
+            logger.error(f"Ошибка доставки в Telegram: {e}")
+        if metrics_server is not None:
+            metrics_server.close()
+        if not daemon:
+            metrics.set('outbox_pending', service.store.outbox_pending())
+            try:
+                write_run_summary(service.app_path)
+            except Exception as e:
+                logger.error(f"Ошибка записи {RUN_SUMMARY_FILE}: {e}")
+        await service.close()
+
+    logger.info("Сервис завершён.")
+
+async def process_feeds(service: Service, fetched, feed_cache, deadline=None):
+    """Генерирует заголовки для новых статей из всех изменившихся лент и переписывает их RSS."""
+    known, failed, deferred = await process_entries(service, fetched, deadline)
+    # Отложенные статьи, как и неудачные, должны попасть в следующий проход
+    write_outputs(service, fetched, known, failed | deferred, feed_cache)
+
+async def process_entries(service: Service, fetched, deadline=None):
+    """Генерирует и сохраняет заголовки новых статей, ставит посты в очередь Telegram.
+
+    fetched — кортежи (feed, валидаторы, ParsedFeed). Статья, которая есть в нескольких
+    лентах, генерируется один раз, а её заголовок используется во всех выходных RSS
+    и постится в каждый канал, где её ещё не было. Новые статьи идут от свежих к старым
+    волнами по RUN_WAVE; каждая волна сохраняется сразу, а после deadline (time.monotonic())
+    оставшиеся откладываются. Возвращает (guid → заголовок для всех известных статей,
+    guid неудавшихся, guid отложенных).
+    """
+    store = service.store
+
+    all_guids = [entry.guid for _, _, page in fetched for entry in page.entries if entry.guid]
+    # Уже обработанные ищем одним запросом
+    known = store.titles(all_guids)
+
+    # Новые статьи; для каждой — каналы, куда её нужно отправить
+    pending = {}
+    published = {}
+    with metrics.span('preprocess'):
+        for feed, _, page in fetched:
+            for entry in page.entries:
+                guid = entry.guid
+                if not guid or guid in known:
+                    continue
+                if guid not in pending:
+                    moment = published_at(entry)
+                    published[guid] = moment.timestamp() if moment else float('-inf')
+                    old_title = entry.title
+                    prepared = preprocess_entry(old_title, entry.description)
+                    prompt = service.prompt_template.replace('{{TITLE}}', prepared.title).replace('{{DESCRIPTION}}', prepared.description)
+                    cache_key = LLMCache.key(service.llm.cache_id, service.prompt_hash, prepared.title, prepared.description)
+                    pending[guid] = (old_title, prepared, prompt, cache_key, [])
+                channels = pending[guid][4]
+                if feed.channel_id and feed.channel_id not in channels:
+                    channels.append(feed.channel_id)
+    metrics.inc('articles_seen', len(set(all_guids)))
+    metrics.inc('articles_new', len(pending))
+
+    # Свежие вперёд: если бюджета не хватит, отложены будут самые старые.
+    # Статьи без даты — в конце, в порядке лент
+    pending = dict(sorted(pending.items(), key=lambda item: -published[item[0]]))
+
+    # Перепечатки не генерируются: они получают заголовок оригинала
+    fingerprints, duplicates = {}, {}
+    if service.similar is not None:
+        with metrics.span('dedup'):
+            fingerprints, duplicates = find_duplicates(service.similar, pending)
+
+    new_count = 0
+    reused = 0
+    failed = set()
+    deferred = set()
+
+    queue = list(pending.items())
+    for start in range(0, len(queue), RUN_WAVE):
+        wave = queue[start:start + RUN_WAVE]
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and remaining <= 0:
+            deferred.update(guid for guid, _ in queue[start:])
+            break
+        originals = [(guid, item) for guid, item in wave if guid not in duplicates]
+
+        # Картинки для постов качаются и проверяются, пока генерируются заголовки
+        service.images.prefetch(prepared.image_url for _, (_, prepared, _, _, channels) in originals if channels)
+
+        try:
+            with metrics.span('generate'):
+                generated = await asyncio.wait_for(generate_titles(
+                    service, [(guid, prepared, prompt, cache_key) for guid, (_, prepared, prompt, cache_key, _) in originals]
+                ), remaining)
+        except asyncio.TimeoutError:
+            # Готовые ответы уже в кэше LLM: следующий проход возьмёт их оттуда
+            deferred.update(guid for guid, _ in queue[start:])
+            break
+        titles = {guid: title for (guid, _), title in zip(originals, generated)}
+
+        for guid, (old_title, prepared, _, _, channels) in wave:
+            original = None
+            if guid in duplicates:
+                # Заголовка нет, если оригинал — тоже новая статья: он сохранён в этой или прошлой волне
+                original, new_title = duplicates[guid]
+                new_title = new_title or known.get(original)
+            else:
+                new_title = titles.get(guid)
+            if new_title is None:
+                failed.add(guid)
+                continue
+
+            # Перепечатку не постим туда, куда уже ушёл оригинал
+            skipped = [channel_id for channel_id in channels if original and store.posted([original], channel_id)]
+            # Сохраняем сразу вместе с постами в очередь Telegram, чтобы падение
+            # посреди запуска не привело ни к повторной генерации, ни к потере поста
+            post = build_telegram_post(new_title, prepared, guid)
+            try:
+                with metrics.span('store'):
+                    store.add(
+                        guid, old_title, new_title, skipped=skipped,
+                        posts=[(channel_id, post) for channel_id in channels if channel_id not in skipped],
+                    )
+            except Exception as e:
+                logger.error(f"Ошибка сохранения статьи {guid} в {ARTICLES_DB}: {e}")
+                failed.add(guid)
+                continue
+            known[guid] = new_title
+            new_count += 1
+
+            if original is not None:
+                logger.info(f"Статья {guid} — перепечатка {original}, заголовок взят у неё")
+                reused += 1
+            elif guid in fingerprints:
+                try:
+                    service.similar.add(guid, fingerprints[guid])
+                except Exception as e:
+                    logger.error(f"Ошибка сохранения отпечатка статьи {guid}: {e}")
+
+            # Отправкой занимается TelegramDelivery в отдельной задаче
+            service.delivery.notify()
+
+    if deferred:
+        logger.warning(
+            f"Бюджет прохода {RUN_BUDGET:.0f} с исчерпан: {len(deferred)} из {len(pending)} новых статей "
+            f"отложено до следующего запуска"
+        )
+        metrics.inc('articles_deferred', len(deferred))
+
+    # Статьи, обработанные раньше через другую ленту, отправляем в каналы, где их ещё не было
+    for feed, _, page in fetched:
+        if not feed.channel_id:
             continue
+        guids = [entry.guid for entry in page.entries if entry.guid in known]
+        posted = store.posted(guids, feed.channel_id)
+        for entry in page.entries:
+            guid = entry.guid
+            if guid not in known or guid in posted or guid in pending:
+                continue
+            prepared = preprocess_entry(entry.title, entry.description)
+            service.images.prefetch([prepared.image_url])
+            try:
+                store.enqueue(guid, feed.channel_id, build_telegram_post(known[guid], prepared, guid))
+            except Exception as e:
+                logger.error(f"Ошибка постановки {guid} в очередь {feed.channel_id}: {e}")
+                failed.add(guid)
+                continue
+            posted.add(guid)
+            service.delivery.notify()
 
-        new_articles[guid] = {
-            'guid': guid,
-            'old_title': old_title,
-            'new_title': new_title
-        }
+    metrics.inc('articles_generated', new_count - reused)
+    metrics.inc('articles_duplicate', reused)
+    metrics.inc('articles_failed', len(failed))
 
-        # Асинхронная отправка в Telegram
-        await send_to_telegram(bot, TELEGRAM_CHANNEL_ID, new_title, description, guid)
+    if new_count:
+        logger.info(f"Сохранено {new_count} новых статей в {ARTICLES_DB}")
 
-    # Сохранение новых статей
-    if new_articles:
-        articles.update(new_articles)
         try:
-            with open(os.path.join(app_path,ARTICLES_FILE), 'w', encoding='utf-8') as f:
-                json.dump(articles, f, ensure_ascii=False, indent=4)
-            logger.info(f"Сохранено {len(new_articles)} новых статей в {ARTICLES_FILE}")
+            removed = store.prune(ARTICLES_MAX_ITEMS, ARTICLES_MAX_AGE_DAYS)
+            if removed:
+                logger.info(f"Удалено {removed} старых статей из {ARTICLES_DB}")
+            service.images.cache.prune(IMAGE_CACHE_DAYS)
+            if service.similar is not None:
+                service.similar.prune()
         except Exception as e:
-            logger.error(f"Ошибка сохранения articles.json: {e}")
+            logger.error(f"Ошибка очистки {ARTICLES_DB}: {e}")
 
+    return known, failed, deferred
+
+def published_at(entry: FeedEntry):
+    """Время публикации статьи в UTC или None, если pubDate нет или он не разбирается."""
+    try:
+        published = parsedate_to_datetime(entry.pub_date)
+    except (TypeError, ValueError):
+        return None
+    if published.tzinfo is None:
+        published = published.replace(tzinfo=timezone.utc)
+    return published.astimezone(timezone.utc)
+
+def published_date(entry: FeedEntry):
+    """Дата публикации статьи в UTC или None."""
+    published = published_at(entry)
+    return published.date() if published else None
+
+def find_duplicates(index: SimilarityIndex, pending):
+    """Отпечатки новых статей и перепечатки среди них.
+
+    Возвращает (guid → отпечаток для оригинальных статей, guid → (guid оригинала,
+    его заголовок)). Оригинал ищется среди сохранённых статей и раньше в pending;
+    во втором случае заголовка ещё нет — вместо него None.
+    """
+    fingerprints, duplicates = {}, {}
+    for guid, (_, prepared, _, _, _) in pending.items():
+        fingerprint = simhash(prepared.description)
+        if fingerprint is None:
+            continue
+        found = index.find(fingerprint)
+        if found is None:
+            for other, value in fingerprints.items():
+                if (value ^ fingerprint).bit_count() <= index.max_distance:
+                    found = (other, None)
+                    break
+        if found is None:
+            fingerprints[guid] = fingerprint
+        else:
+            duplicates[guid] = found
+    return fingerprints, duplicates
+
+def write_outputs(service: Service, feeds, known, failed, feed_cache):
+    """Переписывает выходные RSS и запоминает валидаторы лент, где не было ошибок.
+
+    feeds — кортежи (feed, валидаторы, ParsedFeed).
+    """
+    for feed, validators, page in feeds:
         # Генерация модифицированной RSS-ленты
         try:
-            root = ET.fromstring(rss_content.encode('utf-8'))
-
-            # Определяем namespace (если есть)
-            ns = None
-            if '}' in root.tag:
-                ns_uri = root.tag.split('}')[0][1:]
-                ns = {'ns': ns_uri}
-                channel_path = './/ns:channel'
-                item_path = './/ns:item'
-                title_path = 'ns:title'
-                desc_path = 'ns:description'
-                guid_path = 'ns:guid'
-                managing_editor_path = 'ns:managingEditor'
-            else:
-                channel_path = './/channel'
-                item_path = './/item'
-                title_path = 'title'
-                desc_path = 'description'
-                guid_path = 'guid'
-                managing_editor_path = 'managingEditor'
-
-            # Находим канал
-            channel = root.find(channel_path, ns)
-            if channel is None:
-                raise ValueError("Не найден элемент <channel> в RSS")
-
-            # Удаляем managingEditor, если есть
-            managing_editor = channel.find(managing_editor_path, ns)
-            if managing_editor is not None:
-                channel.remove(managing_editor)
-
-            # Заменяем title и description канала
-            channel_title = channel.find(title_path, ns)
-            if channel_title is not None:
-                channel_title.text = "Честная ИИ-лента Хабра"
-
-            channel_desc = channel.find(desc_path, ns)
-            if channel_desc is not None:
-                channel_desc.text = "Честная ИИ-лента Хабра"
-
-            # Заменяем заголовки в статьях
-            for item in root.findall(item_path, ns):
-                guid_elem = item.find(guid_path, ns)
-                if guid_elem is not None and guid_elem.text and guid_elem.text.strip() in articles:
-                    guid = guid_elem.text.strip()
-                    title_elem = item.find(title_path, ns)
-                    if title_elem is not None:
-                        title_elem.text = articles[guid]['new_title']
-
-            # Красивая и компактная запись без лишних пробелов и пустых строк
-            def indent(elem, level=0):
-                """Компактный indent без пустых строк"""
-                i = "\n" + level * "  "
-                if len(elem):
-                    if not elem.text or not elem.text.strip():
-                        elem.text = i + "  "
-                    for e in elem:
-                        indent(e, level + 1)
-                        if not e.tail or not e.tail.strip():
-                            e.tail = i + "  "
-                    if not elem[-1].tail or not elem[-1].tail.strip():
-                        elem[-1].tail = i
+            output_path = os.path.join(service.app_path, feed.output)
+            with metrics.span('rss_write'):
+                if ARCHIVE_ITEMS > 0:
+                    written = write_archive(output_path, service.archive, [page], known) is not None
                 else:
-                    if level and (not elem.tail or not elem.tail.strip()):
-                        elem.tail = i
-
-            indent(root)
-
-            # Записываем файл чисто и компактно
-            tree = ET.ElementTree(root)
-            with open(os.path.join(app_path,RSS_OUTPUT_FILE), 'wb') as f:
-                tree.write(
-                    f,
-                    encoding='utf-8',
-                    xml_declaration=True,
-                    method='xml'
+                    write_rss(output_path, [page], known)
+                    written = True
+            if written:
+                logger.info(f"Сгенерирована чистая модифицированная лента: {feed.output}")
+            else:
+                logger.info(f"В архиве {feed.output} ещё нет статей, прежний файл оставлен как есть")
+        except Exception as e:
+            logger.error(f"Ошибка генерации RSS {feed.name}: {e}")
+            continue
+
+        # Валидаторы ленты запоминаем, только если все её статьи обработаны,
+        # иначе неудачные повторятся лишь при следующем изменении ленты
+        if not any(entry.guid in failed for entry in page.entries):
+            feed_cache[feed.url] = validators
+
+    try:
+        save_feed_cache(service.feed_cache_path, feed_cache)
+    except Exception as e:
+        logger.error(f"Ошибка сохранения {FEED_CACHE_FILE}: {e}")
+
+class HostLimiter:
+    """Вежливость к сайтам: не больше rate запросов в секунду на каждый хост."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.hosts = {}
+
+    def bucket(self, url):
+        host = urlsplit(url).netloc
+        bucket = self.hosts.get(host)
+        if bucket is None:
+            bucket = self.hosts[host] = TokenBucket(self.rate, 1)
+        return bucket
+
+    async def acquire(self, url):
+        bucket = self.bucket(url)
+        while True:
+            wait = bucket.delay()
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait)
+        bucket.take()
+
+def backfill_page_url(template, number):
+    if '{page}' in template:
+        return template.replace('{page}', str(number))
+    return f"{template}{'&' if urlsplit(template).query else '?'}page={number}"
+
+
+async def fetch_backfill_page(http: httpx.AsyncClient, limiter: HostLimiter, feed: FeedConfig, url):
+    """Страница бэкфилла; None — страницы нет (404/410), то есть лента кончилась.
+
+    429, 5xx и сетевые ошибки повторяются до BACKFILL_ATTEMPTS раз, остальное пробрасывается.
+    """
+    for attempt in range(1, BACKFILL_ATTEMPTS + 1):
+        await limiter.acquire(url)
+        try:
+            with metrics.span('backfill_fetch'):
+                content, _ = await fetch_feed(http, url, {})
+        except httpx.HTTPStatusError as e:
+            status = e.response.status_code
+            if status in (404, 410):
+                return None
+            if attempt == BACKFILL_ATTEMPTS or (status != 429 and status < 500):
+                raise
+            retry_after = e.response.headers.get('Retry-After', '')
+            delay = float(retry_after) if retry_after.isdigit() else 5 * attempt
+            logger.warning(f"Бэкфилл: {url} ответил {status}, повтор через {delay:.0f} с")
+            limiter.bucket(url).block(delay)
+            continue
+        except httpx.TransportError as e:
+            if attempt == BACKFILL_ATTEMPTS:
+                raise
+            logger.warning(f"Бэкфилл: ошибка загрузки {url}, повтор: {e}")
+            await asyncio.sleep(5 * attempt)
+            continue
+        page = parse_feed(feed, content)
+        if page is None:
+            raise ValueError(f"страница {url} не разбирается")
+        return page
+
+async def run_backfill(service: Service, options):
+    """Догружает старые статьи из постраничной ленты за диапазон дат.
+
+    Страницы качаются BACKFILL_CONCURRENCY воркерами с ограничением на хост и проходят
+    обычную генерацию и сохранение (process_entries); выходные RSS не трогаются.
+    Готовые страницы отмечаются в BackfillCheckpoint, так что прерванный бэкфилл
+    продолжается с первой непройденной страницы. Лента считается пройденной на пустой или
+    отсутствующей странице, на странице, где все статьи старше options.since, и на странице,
+    которая не приносит ничего нового по сравнению с предыдущей: так выглядит сервер, который
+    не понимает параметр страницы и на любой номер отдаёт одно и то же.
+    """
+    feed = service.feeds[0]
+    if options.feed:
+        matching = [item for item in service.feeds if item.name == options.feed]
+        if not matching:
+            raise ValueError(f"Ленты {options.feed} нет в {FEEDS_FILE}")
+        feed = matching[0]
+    if options.no_post:
+        feed = feed._replace(channel_id=None)
+
+    template = options.url or BACKFILL_URL or feed.url
+    job = hashlib.sha256(f'{template}|{options.since}|{options.until}'.encode('utf-8')).hexdigest()[:16]
+    checkpoint = BackfillCheckpoint(service.store.conn)
+    if options.restart and checkpoint.reset(job):
+        logger.info("Бэкфилл: сохранённый прогресс сброшен.")
+    watermark = checkpoint.watermark(job)
+    if watermark:
+        logger.info(f"Бэкфилл: продолжаем со страницы {watermark + 1}, предыдущие пройдены")
+
+    limiter = HostLimiter(BACKFILL_HOST_RATE)
+    next_page = watermark + 1
+    stop_at = options.pages + 1
+    saved = 0
+    # guid статей загруженных страниц: соседние сравниваются, чтобы заметить повторы
+    page_guids = {}
+
+    def in_range(day):
+        if day is None:
+            return options.since is None and options.until is None
+        return (options.since is None or day >= options.since) and (options.until is None or day <= options.until)
+
+    def repeated(number):
+        """Номер более поздней из соседних страниц, не добавившей новых guid, или None."""
+        for earlier, later in ((number - 1, number), (number, number + 1)):
+            if earlier in page_guids and later in page_guids and page_guids[later] <= page_guids[earlier]:
+                return later
+        return None
+
+    async def worker():
+        nonlocal next_page, stop_at, saved
+        while next_page < stop_at:
+            number = next_page
+            next_page += 1
+            url = backfill_page_url(template, number)
+            try:
+                page = await fetch_backfill_page(service.http, limiter, feed, url)
+            except Exception as e:
+                # Страница останется непройденной и загрузится при следующем запуске
+                logger.error(f"Бэкфилл: не удалось загрузить {url}: {e}")
+                metrics.inc('backfill_errors')
+                continue
+            if page is None or not page.entries:
+                stop_at = min(stop_at, number)
+                continue
+
+            guids = frozenset(entry.guid for entry in page.entries if entry.guid)
+            if guids:
+                page_guids[number] = guids
+            later = repeated(number)
+            if later is not None and later < stop_at:
+                stop_at = later
+                logger.warning(
+                    f"Бэкфилл: страница {later} не добавила новых статей к странице {later - 1} — "
+                    f"похоже, {urlsplit(template).netloc} не понимает номер страницы в {template}; "
+                    f"остановка. Задайте шаблон с {{page}} в BACKFILL_URL или --url"
                 )
+            if number >= stop_at:
+                continue
 
-            # Убираем лишние пустые строки в конце файла (на всякий случай)
-            with open(os.path.join(app_path,RSS_OUTPUT_FILE), 'r', encoding='utf-8') as f:
-                lines = f.readlines()
-            with open(os.path.join(app_path,RSS_OUTPUT_FILE), 'w', encoding='utf-8', newline='\n') as f:
-                for line in lines:
-                    if line.strip() or (f.tell() > 0 and f.buffer and f.buffer[-1] != b'\n'):
-                        f.write(line.rstrip('\n') + '\n')
+            days = [published_date(entry) for entry in page.entries]
+            if options.since is not None and all(day is not None and day < options.since for day in days):
+                stop_at = min(stop_at, number + 1)
+            selected = [entry for entry, day in zip(page.entries, days) if in_range(day)]
 
-            logger.info(f"Сгенерирована чистая модифицированная лента: {RSS_OUTPUT_FILE}")
+            failed = set()
+            if selected:
+                guids = {entry.guid for entry in selected if entry.guid}
+                fresh = guids - set(service.store.titles(guids))
+                part = ParsedFeed(page.root, page.channel, page.meta, selected)
+                _, failed, _ = await process_entries(service, [(feed, None, part)])
+                saved += len(fresh - failed)
+            metrics.inc('backfill_pages')
+            if failed:
+                logger.warning(f"Бэкфилл: на странице {number} не обработано {len(failed)} статей, она повторится")
+                continue
+            checkpoint.mark(job, number, len(selected))
+            logger.info(f"Бэкфилл: страница {number}, статей в диапазоне: {len(selected)}")
 
-        except Exception as e:
-            logger.error(f"Ошибка генерации RSS: {e}")
-        
-    logger.info("Сервис завершён.")
+    await asyncio.gather(*(worker() for _ in range(BACKFILL_CONCURRENCY)))
+    logger.info(f"Бэкфилл завершён: новых статей {saved}, пройдено страниц подряд {checkpoint.watermark(job)}")
 
 def main():
-    asyncio.run(main_async())
+    parser = argparse.ArgumentParser(description="Честная ИИ-лента Хабра")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--once', action='store_true', help="один проход и выход (для cron, по умолчанию)")
+    mode.add_argument('--daemon', action='store_true', help="работать постоянно и опрашивать ленту каждые POLL_INTERVAL секунд")
+    parser.add_argument('--profile', nargs='?', const='profile.pstats', metavar='PATH',
+                        help="записать профиль cProfile (по умолчанию profile.pstats); "
+                             "смотреть через snakeviz, flameprof или python -m pstats")
+    commands = parser.add_subparsers(dest='command', metavar='backfill')
+    backfill = commands.add_parser(
+        'backfill', help="догрузить старые статьи из постраничной ленты за диапазон дат",
+        description="Догружает старые статьи из постраничной ленты; прерванный запуск с теми же "
+                    "--url, --since и --until продолжается с места остановки.",
+    )
+    backfill.add_argument('--since', type=date.fromisoformat, metavar='ГГГГ-ММ-ДД',
+                          help="самая ранняя дата публикации (включительно)")
+    backfill.add_argument('--until', type=date.fromisoformat, metavar='ГГГГ-ММ-ДД',
+                          help="самая поздняя дата публикации (включительно)")
+    backfill.add_argument('--pages', type=int, default=BACKFILL_MAX_PAGES,
+                          help="сколько страниц пройти максимум (по умолчанию BACKFILL_MAX_PAGES)")
+    backfill.add_argument('--url', help="шаблон адреса страницы с {page}; по умолчанию BACKFILL_URL "
+                                        "или URL ленты с ?page=N")
+    backfill.add_argument('--feed', help=f"имя ленты из {FEEDS_FILE}, по умолчанию первая")
+    backfill.add_argument('--no-post', action='store_true', help="не ставить статьи в очередь Telegram")
+    backfill.add_argument('--restart', action='store_true', help="забыть сохранённый прогресс и начать сначала")
+    args = parser.parse_args()
+    if args.command == 'backfill' and args.daemon:
+        parser.error("backfill нельзя совмещать с --daemon")
+    options = args if args.command == 'backfill' else None
+
+    if not args.profile:
+        asyncio.run(main_async(daemon=args.daemon, backfill=options))
+        return
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.runcall(asyncio.run, main_async(daemon=args.daemon, backfill=options))
+    finally:
+        profiler.dump_stats(args.profile)
+        logger.info(f"Профиль записан в {args.profile}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
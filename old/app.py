@@ -1,14 +1,17 @@
 import os
 import time
 import json
+import fcntl
+import asyncio
 from threading import Lock
-from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import requests
 import feedparser
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import FileResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 
 load_dotenv()
@@ -23,22 +26,42 @@ AMVERA_ENDPOINT = os.getenv("AMVERA_ENDPOINT", "https://kong-proxy.yc.amvera.ru/
 PAGE_SIZE = 6
 MAX_STORE = int(os.getenv("MAX_STORE", "150"))
 REFRESH_SECONDS = int(os.getenv("REFRESH_SECONDS", "30"))
+STREAM_SECONDS = int(os.getenv("STREAM_SECONDS", "30"))
 
 AI_WORKERS = int(os.getenv("AI_WORKERS", "4"))
-LOCK_STALE_SECONDS = int(os.getenv("LOCK_STALE_SECONDS", "900"))
+PROGRESS_WRITE_SECONDS = float(os.getenv("PROGRESS_WRITE_SECONDS", "0.5"))
+FLUSH_TITLES = int(os.getenv("FLUSH_TITLES", "5"))
+FLUSH_SECONDS = float(os.getenv("FLUSH_SECONDS", "5"))
 
 os.makedirs(DATA_DIR, exist_ok=True)
 ARTICLES_FILE = os.path.join(DATA_DIR, "articles.json")
 PROGRESS_FILE = os.path.join(DATA_DIR, "progress.json")
 GEN_LOCK_FILE = os.path.join(DATA_DIR, "generate.lock")
 
-lock = Lock()
-last_update_time = 0
-
 progress_lock = Lock()
-progress = {"done": 0, "total": 0}
+progress = {"done": 0, "total": 0, "local": False, "written": None, "written_at": 0.0, "file_key": None, "file_data": None}
+
+snapshot_lock = Lock()
+snapshot = {"key": None, "etag": "", "items": [], "pages": {}}
+
+subscribers_lock = Lock()
+subscribers = set()
+
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app):
+    task = asyncio.create_task(scheduler())
+    try:
+        yield
+    finally:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+
+app = FastAPI(lifespan=lifespan)
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 INDEX_HTML = os.path.join(BASE_DIR, "templates", "index.html")
@@ -101,6 +124,55 @@ def read_articles():
         return []
 
 
+def sort_articles(items):
+    items.sort(key=lambda x: (to_int(x.get("ts")), s(x.get("title"))), reverse=True)
+    return items
+
+
+def get_snapshot():
+    global snapshot
+    key = file_key(ARTICLES_FILE)
+    snap = snapshot
+    if key is not None and snap["key"] == key:
+        return snap
+
+    with snapshot_lock:
+        if snapshot["key"] != key or key is None:
+            etag = "empty" if key is None else "%x-%x-%x" % key
+            snapshot = {"key": key, "etag": etag, "items": sort_articles(read_articles()), "pages": {}}
+        return snapshot
+
+
+def render_page(snap, offset, limit):
+    body = snap["pages"].get(offset)
+    if body is not None:
+        return body
+
+    items = snap["items"]
+    part = items[offset:offset + limit]
+    body = json.dumps({
+        "count": len(part),
+        "total": len(items),
+        "offset": offset,
+        "limit": limit,
+        "has_more": (offset + limit) < len(items),
+        "version": snap["etag"],
+        "items": part,
+    }, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    if offset < len(items):
+        snap["pages"][offset] = body
+    return body
+
+
+def etag_matches(request, etag):
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    tags = [t.strip() for t in header.split(",")]
+    return "*" in tags or etag in tags
+
+
 def entry_ts(entry):
     t = getattr(entry, "published_parsed", None) or getattr(entry, "updated_parsed", None)
     if not t:
@@ -120,9 +192,55 @@ def save_progress(done, total):
     with progress_lock:
         progress["done"] = int(done)
         progress["total"] = int(total)
+        data = {"done": progress["done"], "total": progress["total"]}
+        now = time.time()
+        finished = data["done"] >= data["total"]
+        if data != progress["written"] and (finished or now - progress["written_at"] >= PROGRESS_WRITE_SECONDS):
+            try:
+                write_json(PROGRESS_FILE, data)
+                progress["written"] = data
+                progress["written_at"] = now
+            except Exception:
+                pass
+    publish_progress()
+
+
+def file_key(path):
+    try:
+        st = os.stat(path)
+    except Exception:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+def read_progress():
+    with progress_lock:
+        if progress["local"]:
+            return {"done": progress["done"], "total": progress["total"]}
+
+        key = file_key(PROGRESS_FILE)
+        if key is not None and key == progress["file_key"]:
+            return dict(progress["file_data"])
+
+        data = load_progress_from_file()
+        progress["file_key"] = key
+        progress["file_data"] = data
+        return dict(data)
+
+
+def progress_event():
+    data = read_progress()
+    data["version"] = get_snapshot()["etag"]
+    return data
+
+
+def publish_progress():
+    with subscribers_lock:
+        targets = list(subscribers)
+    for loop, queue in targets:
         try:
-            write_json(PROGRESS_FILE, {"done": progress["done"], "total": progress["total"]})
-        except Exception:
+            loop.call_soon_threadsafe(queue.put_nowait, None)
+        except RuntimeError:
             pass
 
 
@@ -139,58 +257,42 @@ def load_progress_from_file():
         return {"done": 0, "total": 0}
 
 
-def lock_is_stale(path):
+def try_take_generate_lock():
     try:
-        if not os.path.isfile(path):
-            return False
-        age = time.time() - os.path.getmtime(path)
-        return age > LOCK_STALE_SECONDS
+        fd = os.open(GEN_LOCK_FILE, os.O_CREAT | os.O_RDWR, 0o644)
     except Exception:
-        return False
-
-
-def try_take_generate_lock():
-    if lock_is_stale(GEN_LOCK_FILE):
-        try:
-            os.remove(GEN_LOCK_FILE)
-        except Exception:
-            pass
+        return None
 
     try:
-        fd = os.open(GEN_LOCK_FILE, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
-        try:
-            os.write(fd, str(os.getpid()).encode("utf-8"))
-        except Exception:
-            pass
-        return fd
-    except FileExistsError:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
         return None
+
+    try:
+        os.ftruncate(fd, 0)
+        os.write(fd, str(os.getpid()).encode("utf-8"))
     except Exception:
-        return None
+        pass
+
+    with progress_lock:
+        progress["local"] = True
+    return fd
 
 
 def release_generate_lock(fd):
+    with progress_lock:
+        progress["local"] = False
     try:
-        os.close(fd)
+        fcntl.flock(fd, fcntl.LOCK_UN)
     except Exception:
         pass
     try:
-        if os.path.isfile(GEN_LOCK_FILE):
-            os.remove(GEN_LOCK_FILE)
+        os.close(fd)
     except Exception:
         pass
 
 
-def wait_for_generation_finish(max_wait_seconds=300):
-    start = time.time()
-    while True:
-        if not os.path.isfile(GEN_LOCK_FILE):
-            return True
-        if time.time() - start > max_wait_seconds:
-            return False
-        time.sleep(0.3)
-
-
 def call_ai(original_title):
     if not original_title:
         return original_title
@@ -225,14 +327,14 @@ def call_ai(original_title):
     return text
 
 
-def update_from_rss(rss_url):
+def load_from_rss(rss_url):
     r = requests.get(rss_url, timeout=20, headers={"User-Agent": "honest-rss-api/1.0"})
     r.raise_for_status()
 
     parsed = feedparser.parse(r.text)
     entries = list(parsed.entries or [])
 
-    old_items = read_articles()
+    old_items = get_snapshot()["items"]
 
     saved_by_link = {}
     saved_by_original = {}
@@ -286,23 +388,10 @@ def update_from_rss(rss_url):
         new_items.append(item)
         count += 1
 
-    new_items.sort(key=lambda x: (to_int(x.get("ts")), s(x.get("title"))), reverse=True)
-    write_json(ARTICLES_FILE, new_items[:MAX_STORE])
+    return sort_articles(new_items)[:MAX_STORE]
 
 
-def need_generate(it):
-    if not AMVERA_API_TOKEN:
-        return False
-    orig = s(it.get("original_title"))
-    title = s(it.get("title"))
-    if not orig:
-        return False
-    if (not title) or (title == orig):
-        return True
-    return False
-
-
-def generate_titles_for_all(items):
+def generate_titles_for_all(items, flush=None):
     if not AMVERA_API_TOKEN:
         save_progress(0, 0)
         return
@@ -342,106 +431,141 @@ def generate_titles_for_all(items):
     if workers > 8:
         workers = 8
 
-    jobs = []
-    with ThreadPoolExecutor(max_workers=workers) as ex:
-        for idx in to_do:
-            it = items[idx]
-            orig = s(it.get("original_title"))
-
-            if orig in ready_titles:
-                jobs.append((idx, None, orig))
-                continue
+    jobs = {}
+    for idx in to_do:
+        orig = s(items[idx].get("original_title"))
+        jobs.setdefault(orig, []).append(idx)
+        if not s(items[idx].get("title")):
+            items[idx]["title"] = orig
 
-            future = ex.submit(call_ai, orig)
-            jobs.append((idx, future, orig))
+    pending = set(to_do)
+    done_now = 0
+    unflushed = 0
+    last_flush = time.time()
 
-        done_now = 0
-        for idx, future, orig in jobs:
-            it = items[idx]
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        futures = {ex.submit(call_ai, orig): orig for orig in jobs}
+
+        for future in as_completed(futures):
+            orig = futures[future]
+            try:
+                new_title = s(future.result())
+            except Exception:
+                new_title = orig
+            if not new_title:
+                new_title = orig
+
+            for idx in jobs[orig]:
+                items[idx]["title"] = new_title
+                pending.discard(idx)
+
+            done_now += len(jobs[orig])
+            unflushed += 1
+            save_progress(done_now, len(to_do))
 
-            if orig in ready_titles:
-                it["title"] = ready_titles[orig]
-            else:
+            if flush and pending and (unflushed >= FLUSH_TITLES or time.time() - last_flush >= FLUSH_SECONDS):
                 try:
-                    new_title = future.result()
+                    flush(items)
                 except Exception:
-                    new_title = orig
+                    pass
+                unflushed = 0
+                last_flush = time.time()
 
-                new_title = s(new_title)
-                if not new_title:
-                    new_title = orig
+    save_progress(len(to_do), len(to_do))
 
-                it["title"] = new_title
 
-                if orig and new_title and new_title != orig:
-                    ready_titles[orig] = new_title
+def store_articles(items):
+    items = sort_articles(list(items))[:MAX_STORE]
+    if items != get_snapshot()["items"]:
+        write_json(ARTICLES_FILE, items)
+        publish_progress()
 
-            done_now += 1
-            save_progress(done_now, len(to_do))
 
-    save_progress(len(to_do), len(to_do))
+def refresh_once(rss_url):
+    fd = try_take_generate_lock()
+    if fd is None:
+        return False
+
+    try:
+        items = load_from_rss(rss_url)
+        generate_titles_for_all(items, store_articles)
+        store_articles(items)
+    finally:
+        release_generate_lock(fd)
 
+    publish_progress()
+    return True
 
-@app.get("/api/getArticles")
-def get_articles(offset: int = 0, limit: int = PAGE_SIZE, rss_url: str = RSS_URL):
-    global last_update_time
 
+async def scheduler():
+    while True:
+        try:
+            await asyncio.to_thread(refresh_once, RSS_URL)
+        except Exception:
+            pass
+        await asyncio.sleep(REFRESH_SECONDS)
+
+
+@app.get("/api/getArticles")
+def get_articles(request: Request, offset: int = 0, limit: int = PAGE_SIZE):
     offset = clamp(to_int(offset, 0), 0, 10_000_000)
     limit = PAGE_SIZE
 
-    with lock:
-        if offset == 0:
-            now = time.time()
-            if now - last_update_time > REFRESH_SECONDS:
-                update_from_rss(rss_url)
-                last_update_time = now
-
-        items = read_articles()
-        items.sort(key=lambda x: (to_int(x.get("ts")), s(x.get("title"))), reverse=True)
-
-    if offset == 0:
-        need_any = False
-        for it in items:
-            if need_generate(it):
-                need_any = True
-                break
-
-        if need_any:
-            fd = try_take_generate_lock()
-            if fd is None:
-                wait_for_generation_finish(600)
-            else:
-                try:
-                    generate_titles_for_all(items)
-                    write_json(ARTICLES_FILE, items[:MAX_STORE])
-                finally:
-                    release_generate_lock(fd)
-        else:
-            save_progress(0, 0)
-
-        items = read_articles()
-        items.sort(key=lambda x: (to_int(x.get("ts")), s(x.get("title"))), reverse=True)
+    snap = get_snapshot()
+    etag = 'W/"%s-%d-%d"' % (snap["etag"], offset, limit)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
 
-    part = items[offset:offset + limit]
-    has_more = (offset + limit) < len(items)
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
 
-    return {
-        "count": len(part),
-        "total": len(items),
-        "offset": offset,
-        "limit": limit,
-        "has_more": has_more,
-        "items": part,
-    }
+    return Response(content=render_page(snap, offset, limit), media_type="application/json", headers=headers)
 
 
 @app.get("/api/progress")
 def api_progress():
-    data = load_progress_from_file()
-    with progress_lock:
-        progress["done"] = data.get("done", 0)
-        progress["total"] = data.get("total", 0)
-        return {"done": progress["done"], "total": progress["total"]}
+    return read_progress()
+
+
+@app.get("/api/progress/stream")
+async def progress_stream():
+    first = await asyncio.to_thread(progress_event)
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    sub = (loop, queue)
+    with subscribers_lock:
+        subscribers.add(sub)
+
+    async def events():
+        try:
+            yield "retry: 1000\ndata: %s\n\n" % json.dumps(first, ensure_ascii=False)
+            last = first
+            idle = 0
+            deadline = loop.time() + STREAM_SECONDS
+            while loop.time() < deadline:
+                try:
+                    await asyncio.wait_for(queue.get(), timeout=1)
+                    while not queue.empty():
+                        queue.get_nowait()
+                except asyncio.TimeoutError:
+                    pass
+
+                data = await asyncio.to_thread(progress_event)
+                if data != last:
+                    last = data
+                    idle = 0
+                    yield "data: %s\n\n" % json.dumps(data, ensure_ascii=False)
+                    continue
+
+                idle += 1
+                if idle >= 15:
+                    idle = 0
+                    yield ": ping\n\n"
+        finally:
+            with subscribers_lock:
+                subscribers.discard(sub)
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return StreamingResponse(events(), media_type="text/event-stream", headers=headers)
 
 
 @app.get("/")